@@ -0,0 +1,144 @@
+"""Micro-benchmark of card assembly on a synthetic section of 10k paragraphs without qualifying headings.
+
+Compares headers_para/buildcards with the previous string concatenating implementations and times the stages
+of the element stream on their own.
+
+usage: python benchmarks/bench_cardassembly.py [paragraphs]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdfToCardsConverter import (buildcards, elementtostring, finishcard, headers_para, iterbuildcardsfromelements,
+                                 iterelements, newspantable, parsetaggedtext)
+
+
+def reference_buildcards(headerspara, filename, headerdepth):
+    # previous implementation: blocktext grows by concatenation and every element is re-parsed
+    validheaders = [""] * (headerdepth + 1)
+    metadata = [filename, []]
+    cards = []
+    blocktext = ""
+    for ele in headerspara:
+        if "<-Page " in ele:
+            cards.append(finishcard(validheaders, metadata, blocktext))
+            blocktext = ""
+            metadata[1] = ele.replace("-", "").replace("<", "").replace(">", "")
+            continue
+        if '>' not in ele:
+            continue
+        rawdem, text = ele.split(">", 1)
+        denominator = re.sub("[^0-9]", "", rawdem)
+        if denominator != "" and denominator.isnumeric() and "<h" in rawdem and int(denominator) <= headerdepth and "@" not in text:
+            denominator = int(denominator)
+            cards.append(finishcard(validheaders, metadata, blocktext))
+            blocktext = ""
+            validheaders[denominator] = text
+            for i in range(denominator + 1, headerdepth + 1):
+                validheaders[i] = ""
+            text = ""
+        blocktext = blocktext + " " + text
+    if len(blocktext) > 0:
+        cards.append(finishcard(validheaders, metadata, blocktext))
+    return cards
+
+
+def reference_headers_para(spans, size_tag):
+    # previous implementation of headers_para on a span table (without font and color granularity)
+    header_para = []
+    first = True
+    previous_size = None
+    texts, sizes, blockof, blockpage = spans["text"], spans["size"], spans["block"], spans["blockpage"]
+    si = 0
+    bi = 0
+    for pno in range(spans["pagecount"]):
+        header_para.append("<-Page " + str(pno + 1) + ">")
+        while bi < len(blockpage) and blockpage[bi] == pno:
+            block_string = ""
+            while si < len(texts) and blockof[si] == bi:
+                text, size = texts[si], sizes[si]
+                si += 1
+                if text.strip():
+                    if first:
+                        previous_size = size
+                        first = False
+                        block_string = size_tag[size] + text
+                    else:
+                        if size == previous_size:
+                            if block_string and all((c == "|") for c in block_string):
+                                block_string = size_tag[size] + text
+                            if block_string == "":
+                                block_string = size_tag[size] + text
+                            else:
+                                block_string += " " + text
+                        else:
+                            header_para.append(block_string)
+                            block_string = size_tag[size] + text
+                        previous_size = size
+            header_para.append(block_string)
+            bi += 1
+    return header_para
+
+
+def syntheticsection(paragraphs):
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+    tagged = ["<-Page 1>", "<h1>Annual report", "<h2>Notes to the financial statements"]
+    for i in range(paragraphs):
+        tagged.append("<p>" + " ".join(words[(i + k) % len(words)] for k in range(40)))
+    return tagged
+
+
+def syntheticblock(spancount):
+    # one text block on one page with spancount spans of the paragraph size
+    spans = newspantable()
+    spans["pagecount"] = 1
+    spans["blockpage"].append(0)
+    spans["blockuniform"].append(True)
+    for i in range(spancount):
+        text = "span number %d of a very long paragraph" % i
+        for key, value in (("text", text), ("space", False), ("size", 10.0), ("font", "Helvetica"), ("flags", 0),
+                           ("color", 0), ("bbox", (0.0, 0.0, 0.0, 0.0)), ("page", 0), ("block", 0)):
+            spans[key].append(value)
+    return spans
+
+
+def best(func, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tagged = syntheticsection(paragraphs)
+    before, expected = best(reference_buildcards, tagged, "synthetic.pdf", 1)
+    after, cards = best(buildcards, tagged, "synthetic.pdf", 1)
+    assert cards == expected
+    print(f"buildcards   {paragraphs} paragraphs: before {before:.3f}s  after {after:.3f}s  ({before / after:.1f}x)")
+
+    spans = syntheticblock(paragraphs)
+    size_tag = {10.0: "<p>"}
+    before, expected = best(reference_headers_para, spans, size_tag)
+    after, tagged = best(headers_para, spans, size_tag, None, None, False)
+    assert tagged == expected
+    print(f"headers_para {paragraphs} spans in one block: before {before:.3f}s  after {after:.3f}s  ({before / after:.1f}x)")
+
+    # the stages on their own
+    tagged = syntheticsection(paragraphs)
+    elapsed, elements = best(lambda t: list(parsetaggedtext(t)), tagged)
+    print(f"parsetaggedtext             {elapsed:.3f}s")
+    elapsed, _ = best(lambda e: list(map(elementtostring, e)), elements)
+    print(f"elementtostring             {elapsed:.3f}s")
+    elapsed, _ = best(lambda e: list(iterbuildcardsfromelements(e, "synthetic.pdf", 1)), elements)
+    print(f"iterbuildcardsfromelements  {elapsed:.3f}s")
+    elapsed, _ = best(lambda s: list(iterelements([s], size_tag, None, None, False)), spans)
+    print(f"iterelements                {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark of the font/color statistics, size augmentation and heading classification on a synthetic span table.
+
+Compares the NumPy implementation with the previous per span dictionary implementation.
+
+usage: python benchmarks/bench_fontstatistics.py [spans]
+"""
+import io
+import os
+import sys
+import time
+import random
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdfToCardsConverter import font_tags, fonts, getspancolumns, getweightedfontncolorstatisticsofdoc, newspantable
+
+
+def reference_statistics(spans):
+    # previous implementation of getweightedfontncolorstatisticsofdoc
+    colorstats, fontstats, linecount = {}, {}, 0.0
+    for space, font, color in zip(spans["space"], spans["font"], spans["color"]):
+        if not space:
+            colorstats[color] = colorstats[color] + 1 if color in colorstats else 1.0
+            fontstats[font] = fontstats[font] + 1 if font in fontstats else 1.0
+            linecount += 1
+    for k, c in colorstats.items():
+        colorstats[k] = c / linecount
+    for k, c in fontstats.items():
+        fontstats[k] = c / linecount
+    return fontstats, colorstats
+
+
+def reference_fonts(spans, fontstats, colorstats):
+    # previous implementation of the size augmentation and of fonts with font and color granularity
+    sizes = []
+    for space, size, font, color, blockid in zip(spans["space"], spans["size"], spans["font"], spans["color"], spans["block"]):
+        size = float(size)
+        if spans["blockuniform"][blockid] and not space:
+            sizes.append(size*size + size*size*(1/fontstats[font]) + size*0.5*(1/colorstats[color]))
+        else:
+            sizes.append(size*size)
+    styles, font_counts = {}, {}
+    for size, flags, font, color in zip(sizes, spans["flags"], spans["font"], spans["color"]):
+        identifier = "{0}_{1}_{2}_{3}".format(size, flags, font, color)
+        styles[identifier] = {'size': size, 'flags': flags, 'font': font, 'color': color}
+        font_counts[identifier] = font_counts.get(identifier, 0) + 1
+    return sorted(font_counts.items(), key=lambda ele: ele[1], reverse=True), styles
+
+
+def syntheticspans(count, seed=0):
+    r = random.Random(seed)
+    spans = newspantable()
+    styles = [(10.0, 0, "Helvetica", 0)] * 20 + [(14.0, 16, "Helvetica-Bold", 0), (20.0, 16, "Helvetica-Bold", 3355443),
+                                                 (8.0, 2, "Times-Italic", 0), (10.0, 4, "Courier", 255)]
+    block = -1
+    for i in range(count):
+        if i % 8 == 0:
+            block += 1
+            spans["blockpage"].append(block // 20)
+            spans["blockuniform"].append(r.random() < 0.8)
+        size, flags, font, color = r.choice(styles)
+        text = " " if r.random() < 0.05 else "text"
+        for key, value in (("text", text), ("space", text.isspace()), ("size", size), ("font", font), ("flags", flags),
+                           ("color", color), ("bbox", (0.0, 0.0, 0.0, 0.0)), ("page", block // 20), ("block", block)):
+            spans[key].append(value)
+    spans["pagecount"] = block // 20 + 1
+    return spans
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    spans = syntheticspans(count)
+
+    elapsed, _ = timed(getspancolumns, spans)
+    print(f"columns          {count} spans: {elapsed:.3f}s (once per span table)")
+
+    before, (fontstats, colorstats) = timed(reference_statistics, spans)
+    after, stats = timed(getweightedfontncolorstatisticsofdoc, spans)
+    assert stats == (fontstats, colorstats)
+    print(f"statistics       {count} spans: before {before:.3f}s  after {after:.3f}s  ({before / after:.1f}x)")
+
+    before, (expected_counts, expected_styles) = timed(reference_fonts, spans, fontstats, colorstats)
+    after, (font_counts, styles) = timed(fonts, spans, fontstats, colorstats, True)
+    assert (font_counts, styles) == (expected_counts, expected_styles)
+    print(f"sizes and fonts  {count} spans: before {before:.3f}s  after {after:.3f}s  ({before / after:.1f}x)")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, size_tag = timed(font_tags, font_counts, styles)
+    print(f"font_tags        {len(font_counts)} styles: {elapsed:.4f}s")
+
+
+if __name__ == "__main__":
+    main()
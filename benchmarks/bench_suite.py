@@ -0,0 +1,122 @@
+"""Benchmark suite on the synthetic corpus (see syntheticcorpus.py).
+
+Times every pipeline stage (see conversionprofile), getblockswithgranularityColorFont, splitcards and the end to end
+convertpdftocards of every document, compares the times with the stored baseline and checks that the cards did not
+change. Exits with 1 if the cards of a document differ from the baseline.
+
+usage: python benchmarks/bench_suite.py [--scale 1.0] [--repeat 3] [--corpus dir] [--baseline file] [--save-baseline]
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import fitz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pdfToCardsConverter import (buildcards, convertpdftocards, getblockswithgranularityColorFont, splitcards,
+                                 getweightedfontncolorstatisticsofdoc, headers_para, documentstyles, extractspantable)
+from conversionprofile import ConversionProfiler
+from syntheticcorpus import makecorpus
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAXCARDCHARACTERLENGTH = 450
+OVERLAP = 50
+
+
+def carddigest(cards, pdfpath):
+    # sha256 of the cards, independent of the directory the corpus was written to
+    prefix = pdfpath + " "
+    normalized = [{"page_content": c["page_content"], "title": c["metadata"]["title"],
+                   "source": c["metadata"]["source"][len(prefix):] if c["metadata"]["source"].startswith(prefix) else c["metadata"]["source"]}
+                  for c in cards]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def best(func, repeat):
+    # smallest time of repeat runs and the result of the last run
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchdocument(pdfpath, repeat):
+    timings = {}
+
+    elapsed, cards = best(lambda: convertpdftocards(pdfpath, MAXCARDCHARACTERLENGTH, OVERLAP), repeat)
+    timings["convertpdftocards"] = elapsed
+
+    profiler = ConversionProfiler()
+    convertpdftocards(pdfpath, MAXCARDCHARACTERLENGTH, OVERLAP, profiler=profiler)
+    report = profiler.reports[-1]
+    for name, stage in report["stages"].items():
+        timings["stage " + name] = stage["seconds"]
+
+    # the per page block extraction with size augmentation and the splitter on their own
+    doc = fitz.open(pdfpath)
+    fontstats, colorstats = getweightedfontncolorstatisticsofdoc(doc)
+    timings["getblockswithgranularityColorFont"], _ = best(
+        lambda: [getblockswithgranularityColorFont(page, fontstats, colorstats, True) for page in doc], repeat)
+    spans = extractspantable(doc)
+    fontstats, colorstats, size_tag, headinglvl = documentstyles(spans)
+    unsplit = buildcards(headers_para(spans, size_tag, fontstats, colorstats, True), pdfpath, headinglvl)
+    timings["splitcards"], _ = best(lambda: splitcards(unsplit, MAXCARDCHARACTERLENGTH, OVERLAP), repeat)
+    doc.close()
+
+    return {"digest": carddigest(cards, pdfpath), "cards": len(cards), "pages": report["counts"]["pages"],
+            "spans": report["counts"]["spans"], "seconds": timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=1.0, help="factor for the number of pages of the corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing, the fastest is reported")
+    parser.add_argument("--corpus", default=os.path.join(HERE, "corpus"), help="directory of the generated pdfs")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    try:
+        with open(args.baseline, "r", encoding="utf8") as f:
+            baseline = json.load(f)
+    except OSError:
+        baseline = {"documents": {}}
+    if baseline.get("pymupdf") not in (None, fitz.VersionBind):
+        print(f"baseline was recorded with PyMuPDF {baseline['pymupdf']}, this is {fitz.VersionBind}: extraction may differ")
+
+    results = {"pymupdf": fitz.VersionBind, "scale": args.scale, "documents": {}}
+    changed = []
+    for name, pdfpath in makecorpus(args.corpus, args.scale).items():
+        result = benchdocument(pdfpath, args.repeat)
+        key = os.path.basename(pdfpath)
+        results["documents"][key] = result
+        previous = baseline["documents"].get(key)
+        print(f"{key}: {result['pages']} pages, {result['spans']} spans, {result['cards']} cards")
+        for timing, seconds in result["seconds"].items():
+            line = f"  {timing:36s} {seconds:9.4f}s"
+            if previous and timing in previous["seconds"] and previous["seconds"][timing] > 0:
+                line += f"  baseline {previous['seconds'][timing]:9.4f}s  {seconds / previous['seconds'][timing]:5.2f}x"
+            print(line)
+        if previous:
+            same = previous["digest"] == result["digest"]
+            print("  cards " + ("unchanged" if same else f"CHANGED ({previous['cards']} -> {result['cards']} cards)"))
+            if not same:
+                changed.append(key)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=1)
+        print(f"baseline written to {args.baseline}")
+    if changed:
+        print("cards changed for: " + ", ".join(changed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
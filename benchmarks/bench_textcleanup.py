@@ -0,0 +1,46 @@
+"""Benchmark of the text cleanup, per element generator cleanup (previous) against hyphen join per element and
+removal of the non printable characters with a precompiled character class per card (current).
+
+usage: python benchmarks/bench_textcleanup.py [elements]
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdfToCardsConverter import hyphenjoin, normalizetext
+
+
+def reference_cleanup(texts):
+    # previous implementation, cleanup of every element
+    return [''.join(c for c in re.sub(r'([a-zA-Z])- ([a-z])', r'\1\2', t) if c.isprintable()) for t in texts]
+
+
+def current_cleanup(texts, cardsize=20):
+    texts = [hyphenjoin(t) for t in texts]
+    cards = [" " + " ".join(texts[i:i + cardsize]) for i in range(0, len(texts), cardsize)]
+    return [normalizetext(c) for c in cards]
+
+
+def syntheticelements(count, seed=0):
+    r = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consec-", "tetur", "adipis­cing", "elit", "sed\x07", "do", "ﬁnal"]
+    return [" ".join(r.choice(words) for _ in range(r.randrange(5, 60))) for _ in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    texts = syntheticelements(count)
+    start = time.perf_counter()
+    before = reference_cleanup(texts)
+    middle = time.perf_counter()
+    after = current_cleanup(texts)
+    end = time.perf_counter()
+    assert [" " + " ".join(before[i:i + 20]) for i in range(0, len(before), 20)] == after
+    print(f"cleanup {count} elements: before {middle - start:.3f}s  after {end - middle:.3f}s  ({(middle - start) / (end - middle):.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Benchmark of convertpdftocards with 1 to N worker processes.
+
+usage: python benchmarks/bench_workers.py document.pdf [maxworkers]
+"""
+import io
+import os
+import sys
+import time
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdfToCardsConverter import convertpdftocards
+
+
+def timeconversion(pdfpath, workers, maxcardcharacterlength=450, overlap=50):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        cards = convertpdftocards(pdfpath, maxcardcharacterlength, overlap, workers=workers)
+        return time.perf_counter() - start, cards
+
+
+def main():
+    pdfpath = sys.argv[1]
+    maxworkers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    serialtime, serialcards = timeconversion(pdfpath, 1)
+    print(f"workers=1  {serialtime:8.3f}s  speedup 1.00x  cards {len(serialcards)}")
+    workers = 2
+    while workers <= maxworkers:
+        elapsed, cards = timeconversion(pdfpath, workers)
+        same = "same output" if cards == serialcards else "OUTPUT DIFFERS"
+        print(f"workers={workers:<2d} {elapsed:8.3f}s  speedup {serialtime / elapsed:.2f}x  {same}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
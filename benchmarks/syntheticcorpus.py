@@ -0,0 +1,96 @@
+"""Generator of synthetic PDFs for the benchmarks, the same spec and seed always give the same text and layout.
+
+usage: python benchmarks/syntheticcorpus.py outputdir [scale]
+"""
+import os
+import sys
+import random
+
+import fitz
+
+WORDS = ("alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu nu xi omicron pi rho sigma tau upsilon "
+         "phi chi psi omega report annual revenue segment market product service custom- er employee").split()
+FONTS = ["helv", "tiro", "cour", "heit", "tiit", "coit"]  # base 14 fonts, the first one is the paragraph font
+HEADINGFONTS = ["hebo", "tibo", "cobo"]
+COLORS = [(0, 0, 0), (0.2, 0, 0.6), (0.6, 0, 0), (0, 0.4, 0), (0.3, 0.3, 0.3), (0, 0, 0.8)]
+
+# name -> parameters of makepdf, pages are multiplied by the scale of the corpus
+CORPUS = {
+    "plain": dict(pages=20, headingdepth=2, fonts=1, colors=1),
+    "deepheadings": dict(pages=20, headingdepth=6, fonts=2, colors=2),
+    "manyfonts": dict(pages=20, headingdepth=3, fonts=6, colors=6),
+    "tables": dict(pages=20, headingdepth=2, fonts=1, colors=1, tables=0.5),
+    "longsections": dict(pages=20, headingdepth=2, fonts=1, colors=1, sectionlength=400),
+    "large": dict(pages=200, headingdepth=3, fonts=3, colors=3, tables=0.1),
+}
+
+
+def makepdf(path, pages=10, headingdepth=3, fonts=1, colors=1, tables=0.0, sectionlength=30, seed=0):
+    """Writes a synthetic pdf.
+    :param path: output path
+    :param pages: number of pages
+    :param headingdepth: number of heading levels, level 1 is the largest font size
+    :param fonts: number of body fonts mixed into the paragraphs
+    :param colors: number of colors used for emphasized runs
+    :param tables: share of the lines that are table rows, cells of numbers and words without spaces
+    :param sectionlength: average number of lines between two headings
+    :param seed: random seed
+    """
+    r = random.Random(seed)
+    doc = fitz.open()
+    headingsizes = [24 - 14 * level / max(headingdepth, 1) for level in range(headingdepth)]
+    for pno in range(pages):
+        page = doc.new_page()
+        y = 60
+        while y < page.rect.height - 60:
+            if r.random() < 1.0 / sectionlength:
+                level = r.randrange(headingdepth)
+                text = "%s %d %s" % (r.choice(WORDS).capitalize(), pno + 1, " ".join(r.choice(WORDS) for _ in range(r.randrange(1, 4))))
+                page.insert_text((50, y), text, fontsize=headingsizes[level], fontname=HEADINGFONTS[level % len(HEADINGFONTS)],
+                                 color=COLORS[level % colors] if colors > 1 else COLORS[0])
+                y += headingsizes[level] + 10
+            elif r.random() < tables:
+                x = 50
+                for _ in range(r.randrange(3, 7)):  # one span per cell
+                    cell = "".join(r.choice(WORDS) if r.random() < 0.3 else str(r.randrange(10 ** 6)) for _ in range(r.randrange(1, 4)))
+                    page.insert_text((x, y), cell, fontsize=9, fontname=FONTS[0])
+                    x += fitz.get_text_length(cell, fontname=FONTS[0], fontsize=9) + 12
+                    if x > page.rect.width - 120:
+                        break
+                y += 13
+            else:
+                x = 50
+                words = [r.choice(WORDS) for _ in range(r.randrange(8, 14))]
+                runs = [(" ".join(words), FONTS[0], COLORS[0])]
+                if (fonts > 1 or colors > 1) and r.random() < 0.3:  # emphasized run at the end of the line
+                    runs = [(" ".join(words[:-3]) + " ", FONTS[0], COLORS[0]),
+                            (" ".join(words[-3:]), FONTS[r.randrange(fonts)], COLORS[r.randrange(colors)])]
+                for text, fontname, color in runs:
+                    page.insert_text((x, y), text, fontsize=10, fontname=fontname, color=color)
+                    x += fitz.get_text_length(text, fontname=fontname, fontsize=10)
+                y += 14
+    doc.save(path, garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+
+
+def makecorpus(outputdir, scale=1.0, seed=0):
+    """Writes every pdf of CORPUS that does not exist yet.
+    :param outputdir: directory of the pdfs
+    :param scale: factor for the number of pages
+    :param seed: random seed, every document uses seed + its index
+    :return: {name: path}
+    """
+    os.makedirs(outputdir, exist_ok=True)
+    paths = {}
+    for i, (name, params) in enumerate(CORPUS.items()):
+        params = dict(params, pages=max(1, int(params["pages"] * scale)))
+        path = os.path.join(outputdir, "%s_%d_%d.pdf" % (name, params["pages"], seed + i))
+        if not os.path.exists(path):
+            makepdf(path, seed=seed + i, **params)
+        paths[name] = path
+    return paths
+
+
+if __name__ == "__main__":
+    for name, path in makecorpus(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 1.0).items():
+        print(name, path)
@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import tempfile
+import fitz
+from pdfToCardsConverter import iterpdftocards, documentstyles, extractspantable
+
+
+def filehash(file_path, blocksize=1 << 20):
+    """sha256 of the file content
+    :param file_path: path to the file
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(blocksize), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cachekey(contenthash, maxcardcharacterlength, overlap, usefontsNcolor):
+    # cards depend on the pdf content and on the conversion parameters
+    params = "{0}_{1}_{2}_{3}".format(contenthash, maxcardcharacterlength, overlap, bool(usefontsNcolor))
+    return hashlib.sha256(params.encode("utf8")).hexdigest()
+
+def getcachedcards(cachedir, key, pdfpath):
+    """Returns a generator of the cached cards for the key or None, the card sources are rewritten to pdfpath.
+    An entry is a JSON line with the pdf path followed by one JSON line per card, so the cards are read one at a time.
+    :param cachedir: directory of the cache
+    :param key: cache key (see cachekey)
+    :param pdfpath: path of the pdf the cards are requested for
+    :return: generator of cards or None
+    """
+    entrypath = os.path.join(cachedir, key + ".jsonl")
+    try:
+        f = open(entrypath, "r", encoding="utf8")
+    except OSError:
+        return None
+    try:
+        storedpath = json.loads(f.readline())["pdfpath"]
+    except (ValueError, KeyError, TypeError):
+        f.close()
+        return None
+    os.utime(entrypath)  # mark as recently used for the eviction
+    return readcards(f, storedpath, pdfpath)
+
+def readcards(f, storedpath, pdfpath):
+    # cards of an open cache entry, the file is closed when the generator finishes or is closed
+    prefix = storedpath + " "
+    with f:
+        for line in f:
+            c = json.loads(line)
+            if storedpath != pdfpath and c["metadata"]["source"].startswith(prefix):  # same content stored under another name
+                c["metadata"]["source"] = pdfpath + " " + c["metadata"]["source"][len(prefix):]
+            yield c
+
+def storecards(cachedir, key, pdfpath, cards):
+    """Yields the cards and writes each one to a temporary file as it passes, the cache entry is created atomically
+    (several worker processes may fill the cache at the same time) once all cards are written. Nothing is stored if
+    the iteration stops early.
+    :param cachedir: directory of the cache
+    :param key: cache key (see cachekey)
+    :param pdfpath: path of the pdf the cards belong to
+    :param cards: iterable of cards
+    :return: generator of cards
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as f:
+            f.write(json.dumps({"pdfpath": pdfpath}) + "\n")
+            for card in cards:
+                f.write(json.dumps(card) + "\n")
+                yield card
+        os.replace(tmppath, os.path.join(cachedir, key + ".jsonl"))
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def evictcache(cachedir, maxbytes):
+    """Removes the least recently used entries until the cache is smaller than maxbytes.
+    :param cachedir: directory of the cache
+    :param maxbytes: size limit of the cache
+    :return: number of removed entries
+    """
+    if not os.path.isdir(cachedir):
+        return 0
+    entries = []
+    for name in os.listdir(cachedir):
+        if name.endswith((".json", ".jsonl")):
+            st = os.stat(os.path.join(cachedir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, name in entries:
+        if total <= maxbytes:
+            break
+        os.remove(os.path.join(cachedir, name))
+        total -= size
+        removed += 1
+    return removed
+
+def convertpdftocardscached(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor=True, cachedir="card_cache"):
+    """convertpdftocards with an on-disk cache keyed by the pdf content and the conversion parameters.
+    :param pdfpath: path to pdf
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param cachedir: directory of the cache
+    :return: pdf split in cards by detected header
+    """
+    return list(iterpdftocardscached(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor, cachedir))
+
+def iterpdftocardscached(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor=True, cachedir="card_cache"):
+    """Generator version of convertpdftocardscached, on a cache miss the cards are yielded while iterpdftocards produces them
+    and written to the cache entry on the way, which is complete once the document is finished. Neither a hit nor a
+    miss holds the cards of the whole document.
+    :return: generator of cards
+    """
+    key = cachekey(filehash(pdfpath), maxcardcharacterlength, overlap, usefontsNcolor)
+    cards = getcachedcards(cachedir, key, pdfpath)
+    if cards is None:
+        cards = storecards(cachedir, key, pdfpath, iterpdftocards(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor))
+    yield from cards
+
+def documentstylescached(pdfpath, usefontsNcolor=True, cachedir="card_cache"):
+    """documentstyles of the pdf, cached by the pdf content, e.g. for the page range conversion iterpagestocards.
+    :param pdfpath: path to pdf
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param cachedir: directory of the cache
+    :return: fontstats, colorstats, size_tag, headinglvl
+    """
+    key = hashlib.sha256("{0}_styles_{1}".format(filehash(pdfpath), bool(usefontsNcolor)).encode("utf8")).hexdigest()
+    entrypath = os.path.join(cachedir, key + ".json")
+    try:
+        with open(entrypath, "r", encoding="utf8") as f:
+            entry = json.load(f)
+        os.utime(entrypath)  # mark as recently used for the eviction
+        # colors and sizes are not strings, so the dicts are stored as lists of pairs
+        return (dict(entry["fontstats"]), dict(entry["colorstats"]), dict(entry["size_tag"]), entry["headinglvl"])
+    except (OSError, ValueError, KeyError):
+        pass
+    with fitz.open(pdfpath) as doc:
+        fontstats, colorstats, size_tag, headinglvl = documentstyles(extractspantable(doc, withtext=False), usefontsNcolor)
+    os.makedirs(cachedir, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf8") as f:
+        json.dump({"fontstats": list(fontstats.items()), "colorstats": list(colorstats.items()),
+                   "size_tag": list(size_tag.items()), "headinglvl": headinglvl}, f)
+    os.replace(tmppath, entrypath)
+    return fontstats, colorstats, size_tag, headinglvl
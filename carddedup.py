@@ -0,0 +1,156 @@
+import zlib
+
+import numpy as np
+
+MERSENNE = (1 << 61) - 1
+MAXHASH = (1 << 32) - 1
+
+
+def lshparameters(threshold, numperm, falsenegativeweight=10.0):
+    """Number of bands and rows per band of the LSH index, the pair whose candidate probability 1-(1-s^rows)^bands has the
+    least weighted false positive plus false negative area around the threshold. A false positive only costs a signature
+    comparison, a false negative is a missed duplicate, so false negatives weigh more.
+    :param threshold: Jaccard similarity from which on two texts are duplicates
+    :param numperm: signature length
+    :param falsenegativeweight: weight of the false negative area
+    :return: bands, rows
+    """
+    best = None
+    for rows in range(1, numperm + 1):
+        bands = numperm // rows
+        below = np.linspace(0.0, threshold, 101)
+        above = np.linspace(threshold, 1.0, 101)
+        falsepositive = np.mean(1 - (1 - below ** rows) ** bands) * threshold
+        falsenegative = np.mean((1 - above ** rows) ** bands) * (1 - threshold)
+        cost = falsepositive + falsenegativeweight * falsenegative
+        if best is None or cost < best[0]:
+            best = (cost, bands, rows)
+    return best[1], best[2]
+
+
+class CardDeduplicator:
+    """Near-duplicate filter for card texts: MinHash signatures of the word shingles in an LSH index (banding).
+    A text is compared only with the kept texts sharing a band with it, so the cost per text does not grow with the number
+    of texts seen. The first text of a group of near-duplicates is kept, the later ones are reported as its duplicates.
+    One instance can be used for the cards of one document or of a whole ingestion run.
+    """
+
+    def __init__(self, threshold=0.9, numperm=128, shinglewords=5, seed=1):
+        """
+        :param threshold: estimated Jaccard similarity of the shingle sets from which on a text is a duplicate
+        :param numperm: signature length, more is more accurate and needs more memory (4 bytes each per kept text)
+        :param shinglewords: words per shingle
+        :param seed: seed of the hash permutations, signatures of different seeds do not compare
+        """
+        self.threshold = threshold
+        self.numperm = numperm
+        self.shinglewords = shinglewords
+        r = np.random.RandomState(seed)
+        self.a = r.randint(1, MAXHASH, size=(numperm, 1), dtype=np.uint64)
+        self.b = r.randint(0, MAXHASH, size=(numperm, 1), dtype=np.uint64)
+        self.bands, self.rows = lshparameters(threshold, numperm)
+        self.buckets = [{} for _ in range(self.bands)]  # band hash -> kept id or list of kept ids
+        self.signatures = np.empty((1024, numperm), dtype=np.uint32)
+        self.sources = []  # source of every kept text
+        self.metadata = []  # metadata of every kept card, None for texts passed to check
+        self.seen = 0
+        self.merges = []  # (duplicate source, kept source, similarity)
+        self.forgotten = set()  # ids of kept texts that are no longer compared (see forget)
+
+    def signature(self, text):
+        """MinHash signature of the lower cased word shingles of text.
+        :rtype: np.ndarray
+        :return: numperm uint32 values
+        """
+        words = text.lower().split()
+        if not words:
+            return np.full(self.numperm, MAXHASH, dtype=np.uint32)
+        hashes = np.fromiter((zlib.crc32(w.encode("utf8")) for w in words), dtype=np.uint64, count=len(words))
+        count = max(1, len(words) - self.shinglewords + 1)
+        shingles = np.zeros(count, dtype=np.uint64)
+        for i in range(min(self.shinglewords, len(words))):  # polynomial hash of the words of every shingle
+            shingles = shingles * np.uint64(1000003) + hashes[i:i + count]
+        shingles = (shingles ^ (shingles >> np.uint64(32))) & np.uint64(MAXHASH)
+        # a, b and the shingle hashes are below 2^32, so a*x+b does not overflow 64 bits
+        permuted = (self.a * shingles[np.newaxis, :] + self.b) % np.uint64(MERSENNE) & np.uint64(MAXHASH)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def check(self, text, source=None, metadata=None):
+        """Looks text up in the index and adds it if it is not a near-duplicate of a kept text.
+        :param text: card text
+        :param source: provenance of the text, recorded in merges
+        :param metadata: metadata dict of the card, the sources of its later duplicates are added to its "duplicates"
+        :return: id of the kept text it duplicates, None if it was kept
+        """
+        self.seen += 1
+        signature = self.signature(text)
+        keys = [hash(signature[i*self.rows:(i+1)*self.rows].tobytes()) for i in range(self.bands)]
+        candidates = set()
+        for bucket, key in zip(self.buckets, keys):
+            kept = bucket.get(key)
+            if kept is not None:
+                candidates.update(kept if isinstance(kept, list) else (kept,))
+        candidates -= self.forgotten
+        if candidates:
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            similarities = (self.signatures[candidates] == signature).mean(axis=1)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                kept = int(candidates[best])
+                self.merges.append((source, self.sources[kept], float(similarities[best])))
+                if self.metadata[kept] is not None:
+                    # one string, vectorstore metadata values have to be scalars
+                    previous = self.metadata[kept].get("duplicates")
+                    self.metadata[kept]["duplicates"] = source if not previous else previous + "\n" + source
+                return kept
+        kept = len(self.sources)
+        if kept == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.signatures[kept] = signature
+        self.sources.append(source)
+        self.metadata.append(metadata)
+        for bucket, key in zip(self.buckets, keys):
+            previous = bucket.setdefault(key, kept)
+            if previous != kept:
+                if isinstance(previous, list):
+                    previous.append(kept)
+                else:
+                    bucket[key] = [previous, kept]
+        return None
+
+    def forget(self, ids):
+        """Later texts are no longer dropped as duplicates of these kept texts, e.g. because their stored copies were
+        removed again.
+        :param ids: ids of kept texts, as returned by check for their duplicates
+        """
+        self.forgotten.update(ids)
+
+    def filtercards(self, cards):
+        """Yields the cards that are no near-duplicate of an earlier card. The sources of the dropped cards are kept in
+        metadata["duplicates"] of the card they duplicate, one per line.
+        :param cards: iterable of cards
+        :return: generator of cards
+        """
+        for card in cards:
+            metadata = dict(card["metadata"])  # the parts of a split card share their metadata dict
+            if self.check(card["page_content"], metadata["source"], metadata) is None:
+                card["metadata"] = metadata
+                yield card
+
+    def stats(self):
+        """
+        :rtype: dict
+        :return: {"cards": texts checked, "kept", "duplicates"}
+        """
+        return {"cards": self.seen, "kept": len(self.sources), "duplicates": self.seen - len(self.sources)}
+
+
+def dedupcards(cards, threshold=0.9, deduplicator=None):
+    """Cards without near-duplicates (see CardDeduplicator).
+    :param cards: cards, e.g. of convertpdftocards
+    :param threshold: similarity from which on a card is dropped
+    :param deduplicator: CardDeduplicator shared with other documents of the run, None only compares the cards among themselves
+    :return: kept cards
+    """
+    deduplicator = deduplicator or CardDeduplicator(threshold)
+    return list(deduplicator.filtercards(cards))
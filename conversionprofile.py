@@ -0,0 +1,154 @@
+import sys
+import json
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionProfiler:
+    """Collects per stage timings, counts and peak memory of a pdf to cards conversion.
+    Pass an instance as profiler= to convertpdftocards / iterpdftocards, the report of every converted document is
+    passed to callback(report) and/or appended as one JSON line to jsonlog.
+    Stage times are exclusive, time spent in a nested or upstream stage is only counted there.
+    """
+
+    def __init__(self, callback=None, jsonlog=None, tracememory=False):
+        """
+        :param callback: called with the report dict of every finished document
+        :param jsonlog: path of a JSON lines file the reports are appended to
+        :param tracememory: also report the peak of the python allocations of every document (tracemalloc), slows the
+         conversion down
+        """
+        self.callback = callback
+        self.jsonlog = jsonlog
+        self.tracememory = tracememory
+        self.reports = []
+        self._reset(None)
+
+    def _reset(self, source):
+        self.source = source
+        self.stages = {}  # name -> [seconds, items]
+        self.counts = {}
+        self._nested = []  # time of the nested stages of every running stage
+        self._start = time.perf_counter()
+        self._startrss = peakrss()
+        self._tracing = False  # tracemalloc was started for this document
+        self._tracedbase = 0
+
+    def start(self, source):
+        # begins the report of a document
+        self._reset(source)
+        if self.tracememory:
+            if tracemalloc.is_tracing():  # traced by someone else, measure from the current level
+                tracemalloc.reset_peak()
+                self._tracedbase = tracemalloc.get_traced_memory()[0]
+            else:
+                tracemalloc.start()
+                self._tracing = True
+
+    def _add(self, name, elapsed, items=0):
+        nested = self._nested.pop()
+        stage = self.stages.setdefault(name, [0.0, 0])
+        stage[0] += elapsed - nested
+        stage[1] += items
+        if self._nested:
+            self._nested[-1] += elapsed
+
+    @contextmanager
+    def stage(self, name):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - start)
+
+    def timeiter(self, name, iterable):
+        # times every step of a generator stage and counts its items
+        iterator = iter(iterable)
+        while True:
+            self._nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._add(name, time.perf_counter() - start)
+                return
+            self._add(name, time.perf_counter() - start, 1)
+            yield item
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, complete=True):
+        """Ends the report of the current document and hands it to the callback and the JSON log.
+        The resident memory is only known as the peak of the process lifetime: process_peak_rss_bytes is that peak and
+        rss_peak_growth_bytes how much the document raised it, 0 if an earlier document needed more. peak_traced_bytes
+        (tracememory) is the peak of the python allocations of this document above the level at its start.
+        :param complete: False if the conversion raised or its generator was closed early
+        :rtype: dict
+        :return: {"source", "complete", "seconds", "stages": {name: {"seconds", "items"}}, "counts", "process_peak_rss_bytes",
+         "rss_peak_growth_bytes", "peak_traced_bytes"}
+        """
+        rss = peakrss()
+        report = {
+            "source": self.source,
+            "complete": complete,
+            "seconds": time.perf_counter() - self._start,
+            "stages": {name: {"seconds": seconds, "items": items} for name, (seconds, items) in self.stages.items()},
+            "counts": dict(self.counts),
+            "process_peak_rss_bytes": rss,
+            "rss_peak_growth_bytes": None if rss is None else rss - self._startrss,
+            "peak_traced_bytes": None,
+        }
+        if self.tracememory and tracemalloc.is_tracing():
+            report["peak_traced_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - self._tracedbase)
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+        self.reports.append(report)
+        logger.debug("conversion profile: %s", report)
+        if self.jsonlog:
+            with open(self.jsonlog, "a", encoding="utf8") as f:
+                f.write(json.dumps(report) + "\n")
+        if self.callback is not None:
+            self.callback(report)
+        return report
+
+
+class NullProfiler:
+    # used when no profiler is passed, every hook does nothing
+
+    def start(self, source):
+        pass
+
+    def stage(self, name):
+        return nullcontext()
+
+    def timeiter(self, name, iterable):
+        return iterable
+
+    def count(self, name, value):
+        pass
+
+    def finish(self, complete=True):
+        return None
+
+
+NULLPROFILER = NullProfiler()
+
+
+def peakrss():
+    # peak resident memory of the process in bytes, None where the platform does not report it
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
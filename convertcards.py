@@ -0,0 +1,282 @@
+"""Batch conversion of pdfs into cards, written to JSON lines or Parquet.
+
+usage: python convertcards.py source_documents/ "reports/*.pdf" -o cards.jsonl --workers 8
+       python convertcards.py source_documents/ -o cards_parquet --format parquet --resume
+       python convertcards.py source_documents/ -o cards.jsonl --sentences --max-tokens 80
+
+Every card is one record {"file", "source", "title", "page_content"}. The files whose cards are completely written are
+listed in a manifest next to the output, --resume skips them and continues an interrupted run. A file crashing its worker
+process (e.g. in MuPDF) or taking longer than --timeout seconds is reported as failed, the other files go on.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import CancelledError, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from pdfToCardsConverter import convertpdftocards, splitterprofile
+from exingest import WorkerPool, LoadError, call_isolated
+
+logger = logging.getLogger("convertcards")
+
+
+def findpdfs(inputs):
+    """Expands directories (recursively) and glob patterns into a sorted list of pdf files.
+    :param inputs: directories, glob patterns or files
+    :return: list of paths without duplicates
+    """
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            found.update(glob.glob(os.path.join(item, "**", "*.pdf"), recursive=True))
+        else:
+            found.update(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+    return sorted(found)
+
+
+def convertfile(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor, layout=False, splitter=None):
+    # runs in a worker process, errors are returned so one bad file does not stop the batch
+    try:
+        return pdfpath, convertpdftocards(pdfpath, maxcardcharacterlength, overlap, usefontsNcolor, layout=layout, splitter=splitter), None
+    except Exception as e:
+        return pdfpath, None, f"{type(e).__name__}: {e}"
+
+
+def cardrecords(pdfpath, cards):
+    return [{"file": pdfpath, "source": c["metadata"]["source"], "title": c["metadata"]["title"],
+             "page_content": c["page_content"]} for c in cards]
+
+
+class JsonlCardWriter:
+    # appends the records to one JSON lines file, the position after the last flush is the resume point
+
+    def __init__(self, path, resumeposition=None):
+        self.path = path
+        if resumeposition is None:
+            self.f = open(path, "w", encoding="utf8")
+        else:
+            self.f = open(path, "a+", encoding="utf8")
+            self.f.truncate(resumeposition)  # drop what was written after the last completed flush
+            self.f.seek(resumeposition)
+        self.lines = []
+
+    def add(self, records):
+        self.lines.extend(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        return len(self.lines)
+
+    def flush(self):
+        self.f.write("".join(self.lines))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.lines = []
+        return self.f.tell()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class ParquetCardWriter:
+    # writes every flush as a new part file of the output directory, a part only appears once it is complete
+
+    def __init__(self, path, resumeposition=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.part = resumeposition or 0
+        for name in os.listdir(path):  # parts of an earlier run, or written after the last completed flush
+            if name.startswith("part-") and name.endswith(".parquet") and int(name[5:-8]) >= self.part:
+                os.remove(os.path.join(path, name))
+        self.records = []
+
+    def add(self, records):
+        self.records.extend(records)
+        return len(self.records)
+
+    def flush(self):
+        if self.records:
+            columns = {key: [r[key] for r in self.records] for key in ("file", "source", "title", "page_content")}
+            partpath = os.path.join(self.path, "part-%05d.parquet" % self.part)
+            self.pq.write_table(self.pa.table(columns), partpath + ".tmp")
+            os.replace(partpath + ".tmp", partpath)
+            self.part += 1
+            self.records = []
+        return self.part
+
+    def close(self):
+        self.flush()
+
+
+def manifestpath(output):
+    return output.rstrip("/\\") + ".manifest.jsonl"
+
+
+def readmanifest(path):
+    """Reads the manifest of an earlier run.
+    :return: set of completed files, position of the output after the last completed flush
+    """
+    done = set()
+    position = 0
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # last line of a crashed run
+                    break
+                done.update(entry["files"])
+                position = entry["position"]
+    except OSError:
+        pass
+    return done, position
+
+
+def convertbatch(pdfs, output, outputformat="jsonl", workers=None, maxcardcharacterlength=450, overlap=50, usefontsNcolor=True,
+                 buffercards=10000, resume=False, layout=False, splitter=None, timeout=None):
+    """Converts the pdfs in worker processes and streams the cards to the output.
+    When a worker dies, the pool is replaced and every file that was in flight in it is converted again in a process of its
+    own (see exingest.call_isolated), so only the file causing the crash fails. A file taking longer than timeout seconds
+    fails and its worker is stopped the same way. The files converted before an error stopping the batch are still written.
+    :param pdfs: list of pdf paths
+    :param output: JSON lines file or Parquet directory
+    :param outputformat: "jsonl" or "parquet"
+    :param workers: number of worker processes, default number of cpus
+    :param buffercards: number of cards collected before they are written in one bulk write
+    :param resume: skip the files the manifest lists as completed and continue the output
+    :param layout: read multi-column pages column by column and drop running headers and footers
+    :param splitter: splitter profile of the long cards (see pdfToCardsConverter.splitterprofile), None is the original splitter
+    :param timeout: seconds a file may take, None waits as long as it takes
+    :return: report {"files", "skipped", "converted", "failed", "cards", "seconds"}
+    """
+    workers = workers or os.cpu_count() or 1
+    manifest = manifestpath(output)
+    done, position = readmanifest(manifest) if resume else (set(), None)
+    todo = [p for p in pdfs if p not in done]
+    writer = (ParquetCardWriter if outputformat == "parquet" else JsonlCardWriter)(output, position)
+    # the manifest restarts with the completed files, a line cut off by a crash is dropped
+    with open(manifest + ".tmp", "w", encoding="utf8") as f:
+        if done:
+            f.write(json.dumps({"files": sorted(done), "position": position}) + "\n")
+    os.replace(manifest + ".tmp", manifest)
+    manifestfile = open(manifest, "a", encoding="utf8")
+    report = {"files": len(pdfs), "skipped": len(pdfs) - len(todo), "converted": 0, "failed": [], "cards": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    buffered = []  # files whose cards are in the writer buffer
+    args = (maxcardcharacterlength, overlap, usefontsNcolor, layout, splitter)
+
+    def commit():
+        position = writer.flush()
+        if buffered:
+            manifestfile.write(json.dumps({"files": buffered, "position": position}) + "\n")
+            manifestfile.flush()
+            buffered.clear()
+
+    def failed(pdfpath, error):
+        logger.error("failed %s: %s", pdfpath, error)
+        report["failed"].append((pdfpath, error))
+
+    processes = WorkerPool(workers)
+    isolated = ThreadPoolExecutor(workers)  # threads waiting for the retries in processes of their own
+    running = {}  # future -> pdfpath, submit time, pool generation (None for a retry)
+    try:
+        pending = iter(todo)
+        while True:
+            # keep at most two files per worker in flight, with a timeout only one, a file waiting in the queue would be timed
+            while len(running) < (workers if timeout is not None else 2*workers):
+                pdfpath = next(pending, None)
+                if pdfpath is None:
+                    break
+                running[processes.executor.submit(convertfile, pdfpath, *args)] = (pdfpath, time.monotonic(), processes.generation)
+            if not running:
+                break
+            deadlines = [started + timeout for _, started, generation in running.values() if generation is not None] if timeout is not None else []
+            finished, _ = wait(running, timeout=max(0.0, min(deadlines) - time.monotonic()) if deadlines else None,
+                               return_when=FIRST_COMPLETED)
+            if not finished:
+                # the hung files of the pool fail, the pool is replaced to stop them and its other files are retried below
+                now = time.monotonic()
+                for future, (pdfpath, started, generation) in list(running.items()):
+                    if generation is not None and now - started >= timeout:
+                        del running[future]
+                        failed(pdfpath, f"timed out after {timeout} seconds")
+                        processes.replace(generation)
+                continue
+            for future in finished:
+                pdfpath, _, generation = running.pop(future)
+                try:
+                    pdfpath, cards, error = future.result()
+                except (BrokenProcessPool, CancelledError):
+                    # any file in flight may have killed the worker, each one is retried on its own
+                    processes.replace(generation)
+                    running[isolated.submit(call_isolated, convertfile, (pdfpath, *args), timeout)] = (pdfpath, None, None)
+                    continue
+                except LoadError as e:  # the retry crashed or timed out as well
+                    failed(pdfpath, str(e))
+                    continue
+                if error is not None:
+                    failed(pdfpath, error)
+                    continue
+                buffersize = writer.add(cardrecords(pdfpath, cards))
+                buffered.append(pdfpath)
+                report["converted"] += 1
+                report["cards"] += len(cards)
+                logger.info("[%d/%d] %s: %d cards", report["converted"] + len(report["failed"]), len(todo), pdfpath, len(cards))
+                if buffersize >= buffercards:
+                    commit()
+    finally:
+        # the converted files in the buffer are written even if the batch stops
+        try:
+            commit()
+            writer.close()
+            manifestfile.close()
+        finally:
+            processes.shutdown(terminate=bool(running))  # files still running when the batch stopped are not waited for
+            isolated.shutdown(wait=False, cancel_futures=True)
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert pdfs into cards and write them to JSON lines or Parquet.")
+    parser.add_argument("inputs", nargs="+", help="pdf files, directories or glob patterns")
+    parser.add_argument("-o", "--output", required=True, help="JSON lines file or Parquet directory")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="default from the output name, jsonl unless it ends with .parquet")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default number of cpus")
+    parser.add_argument("--max", type=int, default=450, help="max characters per card")
+    parser.add_argument("--overlap", type=int, default=50, help="overlap between split cards")
+    parser.add_argument("--no-fontscolor", action="store_true", help="detect headers by size only")
+    parser.add_argument("--buffer", type=int, default=10000, help="cards per bulk write")
+    parser.add_argument("--layout", action="store_true", help="read multi-column pages column by column, drop running headers and footers")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run, skip the completed files")
+    parser.add_argument("--sentences", action="store_true", help="cut long cards at sentence ends where possible")
+    parser.add_argument("--max-tokens", type=int, default=None, help="max words per card in addition to --max")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds a file may take before it is reported as failed")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    outputformat = args.format or ("parquet" if args.output.rstrip("/\\").endswith(".parquet") else "jsonl")
+    # without these options the long cards are cut at the positions of the original splitter
+    splitter = None
+    if args.sentences or args.max_tokens is not None:
+        splitter = splitterprofile(compat=False, sentences=args.sentences, maxtokens=args.max_tokens)
+    pdfs = findpdfs(args.inputs)
+    report = convertbatch(pdfs, args.output, outputformat, args.workers, args.max, args.overlap, not args.no_fontscolor,
+                          args.buffer, args.resume, args.layout, splitter, args.timeout)
+    print(f"{report['converted']} converted, {report['skipped']} skipped, {len(report['failed'])} failed of {report['files']} files: "
+          f"{report['cards']} cards in {report['seconds']:.1f}s")
+    for pdfpath, error in report["failed"]:
+        print(f"Failed: {pdfpath}: {error}")
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
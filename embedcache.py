@@ -0,0 +1,114 @@
+import os
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+
+def normalizecontent(text):
+    # texts differing only in whitespace or unicode composition share their embedding
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def embeddingkey(text, model_name):
+    """sha256 of the model name and the normalized text
+    :param text: page content
+    :param model_name: name of the embedding model, vectors of different models never mix
+    :return: hex digest
+    """
+    return hashlib.sha256("{0}\0{1}".format(model_name, normalizecontent(text)).encode("utf8")).hexdigest()
+
+
+class CachedEmbeddings:
+    """Embeddings wrapper that stores every computed vector in a local SQLite file, only unseen texts are passed to
+    the wrapped embeddings. Can be used wherever the wrapped embeddings are (embed_documents, embed_query).
+    Least recently used vectors are evicted once the stored vectors exceed maxbytes.
+    """
+
+    def __init__(self, embeddings, model_name, path="embedding_cache.sqlite3", maxbytes=2 << 30):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # the connection is shared with the embedding writer thread
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)")
+        self.db.commit()
+        self.total, = self.db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()
+        if self.total > self.maxbytes:  # the limit may have been lowered since the last run
+            self._evict()
+
+    def embed_documents(self, texts):
+        keys = [embeddingkey(t, self.model_name) for t in texts]
+        with self.lock:
+            vectors = self._get(keys)
+        missing = {}  # key -> text, every distinct unseen text is embedded once
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        misses = sum(1 for key in keys if key in missing)
+        self.misses += misses
+        self.hits += len(keys) - misses
+        if missing:
+            computed = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing, computed))
+            with self.lock:
+                self._put(computed)
+            vectors.update(computed)
+        return [list(vectors[key]) for key in keys]
+
+    def embed_query(self, text):
+        # queries are not cached, they rarely repeat
+        return self.embeddings.embed_query(text)
+
+    def _get(self, keys):
+        vectors = {}
+        distinct = list(set(keys))
+        for i in range(0, len(distinct), 500):  # stay below the sqlite variable limit
+            part = distinct[i:i+500]
+            rows = self.db.execute("SELECT key, vector FROM vectors WHERE key IN (%s)" % ",".join("?" * len(part)), part)
+            for key, blob in rows:
+                vectors[key] = array.array("d", blob).tolist()
+        if vectors:
+            now = time.time()
+            self.db.executemany("UPDATE vectors SET used = ? WHERE key = ?", [(now, key) for key in vectors])
+            self.db.commit()
+        return vectors
+
+    def _put(self, vectors):
+        now = time.time()
+        rows = [(key, array.array("d", vector).tobytes(), now) for key, vector in vectors.items()]
+        self.db.executemany("INSERT OR REPLACE INTO vectors (key, vector, used) VALUES (?, ?, ?)", rows)
+        self.db.commit()
+        self.total += sum(len(blob) for _, blob, _ in rows)
+        if self.total > self.maxbytes:
+            self._evict()
+
+    def _evict(self):
+        # removes the least recently used vectors until the stored vectors use less than 90% of maxbytes,
+        # so the next batches do not evict again
+        self.total, = self.db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()
+        removed = []
+        for key, size in self.db.execute("SELECT key, LENGTH(vector) FROM vectors ORDER BY used"):
+            if self.total <= self.maxbytes * 0.9:
+                break
+            removed.append((key,))
+            self.total -= size
+        self.db.executemany("DELETE FROM vectors WHERE key = ?", removed)
+        self.db.commit()
+
+    def stats(self):
+        """hits, misses and hit rate of the embed_documents calls
+        :rtype: dict
+        """
+        requested = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requested if requested else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,47 +1,51 @@
+from __future__ import annotations
+
 import os
 import glob
-from typing import List
+import time
+import uuid
+import json
+import queue
+import asyncio
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+import fitz
 from dotenv import load_dotenv
-from pdfToCardsConverter import convertpdftocards
-
-from langchain.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PDFMinerLoader,
-    TextLoader,
-    UnstructuredEmailLoader,
-    UnstructuredEPubLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredODTLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredWordDocumentLoader,
-)
-
-from langchain.text_splitter import RecursiveCharacterTextSplitter, LatexTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.docstore.document import Document
-from constants import CHROMA_SETTINGS
+from pdfToCardsConverter import iterpdftocards
+from cardcache import iterpdftocardscached, evictcache, filehash
+from embedcache import CachedEmbeddings
+from carddedup import CardDeduplicator
+
+# langchain, Chroma and the embedding model are imported on first use, importing them takes seconds and a run
+# converting only pdfs or a service already holding them does not need them
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
 
 
 load_dotenv()
 
+log = logging.getLogger("exingest")
 
-# Map file extensions to document loaders and their arguments
+
+# Map file extensions to document loaders (class names in langchain.document_loaders) and their arguments
 LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
-    # ".docx": (Docx2txtLoader, {}),
-    ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
-    ".eml": (UnstructuredEmailLoader, {}),
-    ".epub": (UnstructuredEPubLoader, {}),
-    ".html": (UnstructuredHTMLLoader, {}),
-    ".md": (UnstructuredMarkdownLoader, {}),
-    ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PDFMinerLoader, {}),
-    ".pptx": (UnstructuredPowerPointLoader, {}),
-    ".txt": (TextLoader, {"encoding": "utf8"}),
+    ".csv": ("CSVLoader", {}),
+    # ".docx": ("Docx2txtLoader", {}),
+    ".docx": ("UnstructuredWordDocumentLoader", {}),
+    ".enex": ("EverNoteLoader", {}),
+    ".eml": ("UnstructuredEmailLoader", {}),
+    ".epub": ("UnstructuredEPubLoader", {}),
+    ".html": ("UnstructuredHTMLLoader", {}),
+    ".md": ("UnstructuredMarkdownLoader", {}),
+    ".odt": ("UnstructuredODTLoader", {}),
+    ".pdf": ("PDFMinerLoader", {}),
+    ".pptx": ("UnstructuredPowerPointLoader", {}),
+    ".txt": ("TextLoader", {"encoding": "utf8"}),
     # Add more mappings for other file extensions and loaders as needed
 }
 
@@ -52,8 +56,9 @@ load_dotenv()
 def load_single_document(file_path: str) -> Document:
     ext = "." + file_path.rsplit(".", 1)[-1]
     if ext in LOADER_MAPPING:
-        loader_class, loader_args = LOADER_MAPPING[ext]
-        loader = loader_class(file_path, **loader_args)
+        import langchain.document_loaders
+        loader_name, loader_args = LOADER_MAPPING[ext]
+        loader = getattr(langchain.document_loaders, loader_name)(file_path, **loader_args)
         return loader.load()[0]
 
     raise ValueError(f"Unsupported file extension '{ext}'")
@@ -62,67 +67,715 @@ def load_single_document(file_path: str) -> Document:
 
 
 
-def load_documents(source_dir: str,chunk_size,chunk_overlap) -> List[Document]:
-    # Loads all documents from source documents directory
+def iter_file_documents(file_path: str, chunk_size, chunk_overlap, cachedir: Optional[str] = None) -> Iterator[Document]:
+    # Yields the chunks of a file as they are produced, pdf cards are streamed by iterpdftocards
+    # (or read from the card cache if cachedir is set), any other supported file is loaded and split
+    from langchain.docstore.document import Document
+    if file_path.endswith(".pdf"):
+        if cachedir:
+            cards = iterpdftocardscached(file_path, chunk_size, chunk_overlap, cachedir=cachedir)
+        else:
+            cards = iterpdftocards(file_path, chunk_size, chunk_overlap)
+        for c in cards:
+            yield Document(page_content=c['page_content'], metadata=c['metadata'])
+    else:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        yield from text_splitter.split_documents([load_single_document(file_path)])
+
+
+def file_page_count(file_path: str) -> int:
+    if file_path.endswith(".pdf"):
+        with fitz.open(file_path) as doc:
+            return doc.page_count
+    return 1
+
+
+def load_file(file_path: str, chunk_size, chunk_overlap, cachedir: Optional[str] = None) -> Tuple[List[Document], int]:
+    # Returns the chunks of a file and its number of pages
+    return list(iter_file_documents(file_path, chunk_size, chunk_overlap, cachedir)), file_page_count(file_path)
+
+
+def _load_file_worker(conn, file_path: str, chunk_size, chunk_overlap, cachedir: Optional[str], batch_size: int):
+    # Runs in a child process, so a corrupt file can neither raise into nor crash the ingestion run.
+    # The chunks are sent in batches as they are produced.
+    try:
+        batch = []
+        for doc in iter_file_documents(file_path, chunk_size, chunk_overlap, cachedir):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                conn.send(("documents", batch))
+                batch = []
+        if batch:
+            conn.send(("documents", batch))
+        conn.send(("done", file_page_count(file_path)))
+    except Exception as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def ingest_files(all_files: List[str], chunk_size, chunk_overlap, workers: Optional[int] = None,
+                 timeout: Optional[float] = None, cachedir: Optional[str] = None,
+                 on_documents: Optional[Callable[[str, List[Document]], None]] = None, batch_size: int = 64) -> Tuple[dict, dict]:
+    # Loads the files with at most `workers` child processes, a file taking longer than `timeout` seconds is stopped.
+    # Batches of chunks are passed to on_documents(file_path, documents) as they arrive, without a callback they are
+    # collected. A failed file may already have delivered some batches.
+    # Returns {file_path: (documents, pages)} for the successful files and a report with failures and throughput.
+    workers = workers or os.cpu_count() or 1
+    pending = list(all_files)
+    running = {}  # connection -> (process, file_path, start time)
+    collected = {}
+    results = {}
+    failures = []
+    start = time.perf_counter()
+
+    def finish(conn, pages=None, error=None):
+        process, file_path, _ = running.pop(conn)
+        docs = collected.pop(file_path, [])
+        if error is None:
+            results[file_path] = (docs, pages)
+        else:
+            failures.append((file_path, error))
+        conn.close()
+        process.join()
+        done = len(results) + len(failures)
+        print(f"[{done}/{len(all_files)}] {'failed' if error else 'loaded'} {file_path}" + (f": {error}" if error else ""))
+
+    def receive(conn):
+        process, file_path, _ = running[conn]
+        try:
+            kind, payload = conn.recv()
+        except EOFError:
+            process.join()
+            finish(conn, error=f"worker died with exit code {process.exitcode}")
+            return
+        if kind == "documents":
+            if on_documents is not None:
+                on_documents(file_path, payload)
+            else:
+                collected.setdefault(file_path, []).extend(payload)
+        elif kind == "done":
+            finish(conn, pages=payload)
+        else:
+            finish(conn, error=payload)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            file_path = pending.pop(0)
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_load_file_worker, args=(writer, file_path, chunk_size, chunk_overlap, cachedir, batch_size), daemon=True)
+            process.start()
+            writer.close()  # only the child holds the writing end, so a crash shows up as EOF
+            running[reader] = (process, file_path, time.perf_counter())
+
+        waittime = None
+        if timeout is not None:
+            waittime = max(0.0, min(started + timeout for _, _, started in running.values()) - time.perf_counter())
+        for conn in wait(list(running), timeout=waittime):
+            receive(conn)
+
+        if timeout is not None:
+            now = time.perf_counter()
+            for conn, (process, file_path, started) in list(running.items()):
+                if now - started >= timeout:
+                    process.terminate()
+                    finish(conn, error=f"timed out after {timeout} seconds")
+
+    elapsed = time.perf_counter() - start
+    pages = sum(p for _, p in results.values())
+    report = {
+        "files": len(all_files),
+        "loaded": len(results),
+        "failed": failures,
+        "pages": pages,
+        "seconds": elapsed,
+        "files_per_second": len(all_files) / elapsed if elapsed > 0 else 0.0,
+        "pages_per_second": pages / elapsed if elapsed > 0 else 0.0,
+    }
+    return results, report
+
+
+class LoadError(Exception):
+    # a file that failed in an isolated worker process, the message is the error reported for the file
+    pass
+
+
+def isolated_messages(target: Callable, args: tuple, timeout: Optional[float] = None) -> Iterator[tuple]:
+    # Runs target(conn, *args) in a child process of its own and yields the (kind, payload) messages it sends. A crash
+    # or running longer than `timeout` seconds in total raises LoadError, the child is stopped when the generator closes.
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=(writer, *args), daemon=True)
+    process.start()
+    writer.close()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            # the sentinel as well, another thread forking at the same time may hold a copy of the writing end, so a
+            # crash does not always show up as EOF
+            if not wait([reader, process.sentinel], None if deadline is None else max(0.0, deadline - time.monotonic())):
+                raise LoadError(f"timed out after {timeout} seconds")
+            try:
+                if not reader.poll():
+                    raise EOFError
+                message = reader.recv()
+            except EOFError:
+                process.join()
+                raise LoadError(f"worker died with exit code {process.exitcode}") from None
+            yield message
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        reader.close()
+
+
+def load_file_isolated(file_path: str, chunk_size, chunk_overlap, cachedir: Optional[str] = None,
+                       timeout: Optional[float] = None) -> Tuple[List[Document], int]:
+    # load_file in a child process of its own like ingest_files does, a crash or a timeout only fails this file and
+    # a file taking longer than `timeout` seconds is stopped. Raises LoadError.
+    messages = isolated_messages(_load_file_worker, (file_path, chunk_size, chunk_overlap, cachedir, 64), timeout)
+    docs = []
+    try:
+        for kind, payload in messages:
+            if kind == "documents":
+                docs.extend(payload)
+            elif kind == "done":
+                return docs, payload
+            else:
+                raise LoadError(payload)
+    finally:
+        messages.close()
+
+
+def _call_worker(conn, function: Callable, args: tuple):
+    # runs in the child process of call_isolated
+    try:
+        conn.send(("done", function(*args)))
+    except Exception as e:
+        conn.send(("failed", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def call_isolated(function: Callable, args: tuple, timeout: Optional[float] = None):
+    # function(*args) in a child process of its own, for other batch jobs that retry a file alone (see
+    # convertcards.convertbatch). Returns the result, an exception, a crash or a timeout raises LoadError.
+    messages = isolated_messages(_call_worker, (function, args), timeout)
+    try:
+        kind, payload = next(messages)
+    finally:
+        messages.close()
+    if kind != "done":
+        raise LoadError(payload)
+    return payload
+
+
+class WorkerPool:
+    # ProcessPoolExecutor that is replaced when it broke (a worker died) or a hung task has to be stopped. Every
+    # replacement starts a new generation, replace(generation) only replaces the pool of that generation once.
+
+    def __init__(self, workers: int, initializer: Optional[Callable] = None):
+        self.workers = workers
+        self.initializer = initializer
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.executor = ProcessPoolExecutor(workers, initializer=initializer)
+
+    def replace(self, generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            old = self.executor
+            self.executor = ProcessPoolExecutor(self.workers, initializer=self.initializer)
+            self.generation += 1
+        self.stop(old)
+
+    @staticmethod
+    def stop(executor: ProcessPoolExecutor):
+        # a ProcessPoolExecutor can not stop a running task, its processes are terminated instead (_processes is not
+        # public, but has been there since python 3.2). The other tasks of the pool fail with BrokenProcessPool.
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait: bool = True, terminate: bool = False):
+        # terminate stops the running tasks instead of waiting for them
+        if terminate:
+            self.stop(self.executor)
+        else:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+# Loaders parsing in python are run in worker processes by aload_files, the others (mostly file I/O and subprocesses) in threads
+CPU_BOUND_EXTENSIONS = {".pdf", ".docx", ".pptx", ".odt", ".epub"}
+
+
+async def aload_files(all_files: List[str], chunk_size, chunk_overlap, workers: Optional[int] = None, concurrency: int = 64,
+                      timeout: Optional[float] = None, cachedir: Optional[str] = None,
+                      on_documents: Optional[Callable[[str, List[Document]], None]] = None,
+                      processes: Optional[WorkerPool] = None) -> Tuple[dict, dict]:
+    # asyncio front-end of ingest_files for corpora of many small files: instead of a process per file, files with a CPU
+    # bound loader (pdf card conversion included) go to a pool of `workers` processes and all other files to a pool of
+    # `concurrency` threads, both run at the same time. on_documents(file_path, documents) is called from the event loop.
+    # A file taking longer than `timeout` seconds is reported as failed. When a worker dies (a crash in MuPDF, the OOM
+    # killer) or a file in a worker times out, the pool is replaced and the files that were in flight in it are loaded
+    # again in a process of their own (see load_file_isolated), so only the cause fails. A file in a thread that times
+    # out can not be stopped and finishes in the background. A running WorkerPool passed as `processes` (warm workers of
+    # a long-running service) is used instead of a new one and left running, `workers` is then its size.
+    # Returns the same results and report as ingest_files.
+    workers = workers or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+    results = {}
+    failures = []
+    start = time.perf_counter()
+
+    ownpool = processes is None
+    if ownpool:
+        processes = WorkerPool(workers)
+    threads = ThreadPoolExecutor(concurrency)
+    timedout = False
+    try:
+        # bounded concurrency: at most two files per process and `concurrency` files in threads are in flight. With a
+        # timeout only one per process, a file waiting in the pool queue would already be timed
+        slots = {processes: asyncio.Semaphore(workers if timeout is not None else 2 * workers), threads: asyncio.Semaphore(concurrency)}
+
+        async def loadinpool(file_path: str):
+            generation = processes.generation
+            try:
+                future = loop.run_in_executor(processes.executor, load_file, file_path, chunk_size, chunk_overlap, cachedir)
+                return await asyncio.wait_for(future, timeout)
+            except BrokenProcessPool:
+                # any file in flight may have killed the worker, each one is retried on its own
+                processes.replace(generation)
+                return await asyncio.to_thread(load_file_isolated, file_path, chunk_size, chunk_overlap, cachedir, timeout)
+            except asyncio.TimeoutError:
+                processes.replace(generation)  # stops the hung worker
+                raise LoadError(f"timed out after {timeout} seconds") from None
+
+        async def load(file_path: str):
+            ext = "." + file_path.rsplit(".", 1)[-1]
+            executor = processes if ext in CPU_BOUND_EXTENSIONS else threads
+            async with slots[executor]:
+                try:
+                    if executor is processes:
+                        docs, pages = await loadinpool(file_path)
+                    else:
+                        future = loop.run_in_executor(threads, load_file, file_path, chunk_size, chunk_overlap, cachedir)
+                        docs, pages = await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    nonlocal timedout
+                    timedout = True
+                    failures.append((file_path, f"timed out after {timeout} seconds"))
+                except LoadError as e:
+                    failures.append((file_path, str(e)))
+                except Exception as e:
+                    failures.append((file_path, f"{type(e).__name__}: {e}"))
+                else:
+                    if on_documents is not None:
+                        on_documents(file_path, docs)
+                        docs = []
+                    results[file_path] = (docs, pages)
+            done = len(results) + len(failures)
+            error = failures[-1][1] if failures and failures[-1][0] == file_path else None
+            print(f"[{done}/{len(all_files)}] {'failed' if error else 'loaded'} {file_path}" + (f": {error}" if error else ""))
+
+        await asyncio.gather(*(load(file_path) for file_path in all_files))
+    finally:
+        # do not wait for files in threads that timed out
+        if ownpool:
+            processes.shutdown()
+        threads.shutdown(wait=not timedout, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    pages = sum(p for _, p in results.values())
+    report = {
+        "files": len(all_files),
+        "loaded": len(results),
+        "failed": failures,
+        "pages": pages,
+        "seconds": elapsed,
+        "files_per_second": len(all_files) / elapsed if elapsed > 0 else 0.0,
+        "pages_per_second": pages / elapsed if elapsed > 0 else 0.0,
+    }
+    return results, report
+
+
+def print_ingest_report(report: dict):
+    print(f"Loaded {report['loaded']} of {report['files']} files ({report['pages']} pages) in {report['seconds']:.1f}s: "
+          f"{report['files_per_second']:.2f} files/s, {report['pages_per_second']:.2f} pages/s")
+    for file_path, error in report["failed"]:
+        print(f"Failed: {file_path}: {error}")
+
+
+def find_files(source_dir: str) -> List[str]:
+    # Lists all supported files of the source documents directory
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(
             glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
         )
-    nonpdfdocs=[]
-    carddocs=[]
+    return all_files
 
-    for file_path in all_files:
+
+def load_files(all_files: List[str], chunk_size, chunk_overlap, workers: Optional[int] = None,
+               timeout: Optional[float] = None, cachedir: Optional[str] = None, asyncloading: bool = False) -> Dict[str, List[Document]]:
+    # Loads and splits the files, returns {file_path: chunks} in file order for every file that could be loaded
+    if asyncloading:
+        results, report = asyncio.run(aload_files(all_files, chunk_size, chunk_overlap, workers, timeout=timeout, cachedir=cachedir))
+    else:
+        results, report = ingest_files(all_files, chunk_size, chunk_overlap, workers, timeout, cachedir)
+    print_ingest_report(report)
+
+    # keep the file order independent of the completion order
+    return {file_path: results[file_path][0] for file_path in all_files if file_path in results}
+
+
+def load_documents(source_dir: str,chunk_size,chunk_overlap, workers: Optional[int] = None, timeout: Optional[float] = None,
+                   cachedir: Optional[str] = None, asyncloading: bool = False) -> List[Document]:
+    # Loads all documents from source documents directory
+    filedocs = load_files(find_files(source_dir), chunk_size, chunk_overlap, workers, timeout, cachedir, asyncloading)
+
+    carddocs=[]
+    nonpdfdocs=[]
+    for file_path, docs in filedocs.items():
         if file_path.endswith(".pdf"):
-            cards=convertpdftocards(file_path,chunk_size,chunk_overlap)
-            carddocs=[]
-            for c in cards:
-                carddocs.append(Document(page_content=c['page_content'], metadata=c['metadata']))#c['metadata']['title']
+            carddocs.extend(docs)
         else:
-            nonpdfdocs.append(load_single_document(file_path))
-            
-    
-    if len(nonpdfdocs)>0:
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        carddocs.extend( text_splitter.split_documents(nonpdfdocs))
+            nonpdfdocs.extend(docs)
+    carddocs.extend(nonpdfdocs)
 
     return carddocs
     #return [load_single_document(file_path) if ".pdf" not in file_path else (file_path,) for file_path in all_files]
 
 
-def main():
-    print("Hello")
-    #os.system("pause")
-    # Load environment variables
-    persist_directory = os.environ.get('PERSIST_DIRECTORY')
-    source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')
-    embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME')
-    modelstorepath= os.environ.get('MODELLOADPATH', 'model/')
-    
-
-    # Load documents and split in chunks
+MANIFEST_NAME = "ingest_manifest.json"
+DUPLICATES_NAME = "duplicates.jsonl"
+
+
+def load_manifest(persist_directory: str) -> dict:
+    # {file_path: {"hash", "size", "mtime", "ids"}} of the files stored in the vectorstore by previous runs
+    try:
+        with open(os.path.join(persist_directory, MANIFEST_NAME), "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(persist_directory: str, manifest: dict):
+    os.makedirs(persist_directory, exist_ok=True)
+    tmppath = os.path.join(persist_directory, MANIFEST_NAME + ".tmp")
+    with open(tmppath, "w", encoding="utf8") as f:
+        json.dump(manifest, f)
+    os.replace(tmppath, os.path.join(persist_directory, MANIFEST_NAME))
+
+
+def save_duplicates(persist_directory: str, merges: List[tuple]):
+    # appends the provenance of the chunks dropped as near-duplicates: their source, the source of the stored chunk
+    # they duplicate and the estimated similarity
+    os.makedirs(persist_directory, exist_ok=True)
+    with open(os.path.join(persist_directory, DUPLICATES_NAME), "a", encoding="utf8") as f:
+        for source, kept, similarity in merges:
+            f.write(json.dumps({"source": source, "kept": kept, "similarity": similarity}) + "\n")
+
+
+def check_source_directory(source_directory: str, manifest: dict):
+    # A vectorstore is kept in sync with one source directory: the files of the manifest that find_files does not list
+    # under it would be taken for removed files and their vectors deleted. The paths are compared as find_files spells
+    # them, so "docs" and "./docs" are different source directories. Raises ValueError if the manifest lists such files.
+    prefix = os.path.join(source_directory, "")
+    outside = [file_path for file_path in manifest if not file_path.startswith(prefix)]
+    if outside:
+        raise ValueError(f"the vectorstore holds files from outside {source_directory} (e.g. {outside[0]}), ingest "
+                         f"from the source directory it was created with or use another persist directory")
+
+
+def add_dependent_files(changed: Dict[str, dict], removed: List[str], manifest: dict) -> List[str]:
+    # Chunks dropped as near-duplicates are only stored once, by the file listed in "duplicates_of" of the manifest
+    # entry of the file they were dropped from. The files depending on a changed or removed file (and the files depending
+    # on those, and so on) lose their stored copies, they are added to changed to be ingested again. Returns them.
+    lost = set(changed) | set(removed)
+    dependents = []
+    while True:
+        more = [file_path for file_path, entry in manifest.items()
+                if file_path not in lost and lost.intersection(entry.get("duplicates_of", ()))]
+        if not more:
+            return dependents
+        for file_path in more:
+            entry = manifest[file_path]
+            changed[file_path] = {"hash": entry["hash"], "size": entry["size"], "mtime": entry["mtime"], "ids": []}
+            lost.add(file_path)
+            dependents.append(file_path)
+
+
+def diff_files(all_files: List[str], manifest: dict) -> Tuple[Dict[str, dict], List[str]]:
+    # Returns the new or changed files with their manifest state and the files that were removed from the source
+    # directory. A file with unchanged size and modification time is not hashed again.
+    changed = {}
+    for file_path in all_files:
+        st = os.stat(file_path)
+        entry = manifest.get(file_path)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            continue
+        contenthash = filehash(file_path)
+        if entry and entry["hash"] == contenthash:
+            entry["size"], entry["mtime"] = st.st_size, st.st_mtime_ns  # touched but not modified
+            continue
+        changed[file_path] = {"hash": contenthash, "size": st.st_size, "mtime": st.st_mtime_ns, "ids": []}
+    present = set(all_files)
+    removed = [file_path for file_path in manifest if file_path not in present]
+    return changed, removed
+
+
+class BatchedStoreWriter:
+    # Consumer stage of the ingestion pipeline: a thread embeds the chunks in batches of batch_size and writes them to
+    # the vectorstore while the producer (the loading workers) keeps converting. The queue between both holds at most
+    # queue_size batches, put blocks when it is full so memory stays bounded. Every log_every-th chunk is logged.
+
+    def __init__(self, db, batch_size: int = 256, queue_size: int = 8, log_every: int = 0):
+        self.db = db
+        self.batch_size = batch_size
+        self.log_every = log_every
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.chunks = 0
+        self.batches = 0
+        self.busy = 0.0  # seconds spent embedding and writing
+        self.start = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name="embedder", daemon=True)
+        self.thread.start()
+
+    def put(self, texts: List[Document], ids: List[str]):
+        if self.error is not None:
+            raise RuntimeError("embedding stage failed") from self.error
+        self.queue.put((texts, ids))
+
+    def _write(self, texts: List[Document], ids: List[str]):
+        started = time.perf_counter()
+        self.db.add_documents(texts, ids=ids)
+        self.busy += time.perf_counter() - started
+        self.batches += 1
+
+    def _run(self):
+        texts, ids = [], []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so the producer never blocks on a full queue
+            for t, i in zip(*item):
+                self.chunks += 1
+                if self.log_every and self.chunks % self.log_every == 0:
+                    log.info("chunk %d: %s", self.chunks, t)
+                texts.append(t)
+                ids.append(i)
+            try:
+                while len(texts) >= self.batch_size:
+                    self._write(texts[:self.batch_size], ids[:self.batch_size])
+                    texts, ids = texts[self.batch_size:], ids[self.batch_size:]
+            except Exception as e:
+                self.error = e
+        if texts and self.error is None:
+            try:
+                self._write(texts, ids)
+            except Exception as e:
+                self.error = e
+
+    def close(self) -> dict:
+        # Writes the last partial batch, waits for the consumer and returns its throughput
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("embedding stage failed") from self.error
+        elapsed = time.perf_counter() - self.start
+        return {
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "seconds": elapsed,
+            "busy_seconds": self.busy,
+            "chunks_per_second": self.chunks / self.busy if self.busy > 0 else 0.0,
+        }
+
+
+def print_pipeline_report(report: dict, chunks: int, store: dict):
+    # throughput of the loading stage (producer) and of the embedding stage (consumer)
+    print(f"Conversion: {chunks} chunks in {report['seconds']:.1f}s, "
+          f"{chunks / report['seconds'] if report['seconds'] > 0 else 0.0:.1f} chunks/s")
+    print(f"Embedding: {store['chunks']} chunks in {store['batches']} batches, {store['busy_seconds']:.1f}s busy of "
+          f"{store['seconds']:.1f}s, {store['chunks_per_second']:.1f} chunks/s")
+
+
+def load_settings() -> dict:
+    # ingestion settings from the environment (.env), shared by the one-shot run and the ingestion service
+    return {
+        "persist_directory": os.environ.get('PERSIST_DIRECTORY'),
+        "source_directory": os.environ.get('SOURCE_DIRECTORY', 'source_documents'),
+        "embeddings_model_name": os.environ.get('EMBEDDINGS_MODEL_NAME'),
+        "modelstorepath": os.environ.get('MODELLOADPATH', 'model/'),
+        "ingest_workers": int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 1)),
+        "ingest_timeout": float(os.environ['INGEST_TIMEOUT']) if os.environ.get('INGEST_TIMEOUT') else None,
+        "cache_directory": os.environ.get('CARD_CACHE_DIRECTORY', 'card_cache'),
+        "cache_maxbytes": int(os.environ.get('CARD_CACHE_MAXBYTES', 1 << 30)),
+        "embed_batch_size": int(os.environ.get('EMBED_BATCH_SIZE', 256)),
+        "embed_queue_size": int(os.environ.get('EMBED_QUEUE_SIZE', 8)),
+        "log_every": int(os.environ.get('INGEST_LOG_EVERY', 0)),  # log every n-th chunk, 0 logs none
+        "ingest_async": os.environ.get('INGEST_ASYNC', '') not in ('', '0'),  # thread and process pools instead of a process per file
+        "ingest_concurrency": int(os.environ.get('INGEST_CONCURRENCY', 64)),
+        "embedding_cache": os.environ.get('EMBEDDING_CACHE', 'embedding_cache.sqlite3'),  # empty disables the cache
+        "embedding_cache_maxbytes": int(os.environ.get('EMBEDDING_CACHE_MAXBYTES', 2 << 30)),
+        "dedup_threshold": float(os.environ['DEDUP_THRESHOLD']) if os.environ.get('DEDUP_THRESHOLD') else None,  # e.g. 0.9, empty keeps every chunk
+    }
+
+
+def open_embeddings(settings: dict):
+    # Loads the embedding model, identical chunks of earlier runs or other files are not embedded again if the
+    # embedding cache is enabled
+    from langchain.embeddings import HuggingFaceEmbeddings
+    embeddings = HuggingFaceEmbeddings(model_name=settings["embeddings_model_name"], cache_folder=settings["modelstorepath"])
+    if settings["embedding_cache"]:
+        embeddings = CachedEmbeddings(embeddings, settings["embeddings_model_name"], settings["embedding_cache"],
+                                      settings["embedding_cache_maxbytes"])
+    return embeddings
+
+
+def open_vectorstore(persist_directory: str, embeddings):
+    from langchain.vectorstores import Chroma
+    from constants import CHROMA_SETTINGS
+    return Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
+
+
+def ingest(settings: dict, embeddings, db, processes: Optional[WorkerPool] = None) -> dict:
+    # Ingests the new and changed files of settings["source_directory"] into the open vectorstore db, vectors of changed
+    # and removed files are replaced. With a running pool `processes` the files are loaded by its workers (see
+    # aload_files). Returns a summary of the run.
+    persist_directory = settings["persist_directory"]
+    source_directory = settings["source_directory"]
+    cache_directory = settings["cache_directory"]
+
     print(f"Loading documents from {source_directory}")
     chunk_size = 450
     chunk_overlap = 50
-    texts = load_documents(source_directory,chunk_size, chunk_overlap)
-    
-    #print(f"Loaded {len(texts)} documents from {source_directory}")
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} characters each)")
+    manifest = load_manifest(persist_directory)
+    check_source_directory(source_directory, manifest)
+    changed, removed = diff_files(find_files(source_directory), manifest)
+    dependents = add_dependent_files(changed, removed, manifest)
+    print(f"{len(changed) - len(dependents)} new or changed files, {len(removed)} removed files" +
+          (f", {len(dependents)} files with near-duplicates of them" if dependents else ""))
+    staleids = [i for file_path in removed + list(changed) if file_path in manifest for i in manifest[file_path]["ids"]]
+    if staleids:
+        db._collection.delete(ids=staleids)
 
-    # print (texts[0],"\n\n")
-    # print (texts[4],"\n\n")
-    # print (texts[-1],"\n\n")
+    # Load documents and split in chunks, the chunks are embedded and stored in batches by the writer thread
+    # while the workers keep converting
+    produced = 0
+    # near-duplicates of chunks stored earlier in this run are neither embedded nor stored, chunks of unchanged files
+    # from earlier runs are not compared
+    dedup = CardDeduplicator(settings["dedup_threshold"]) if settings["dedup_threshold"] else None
+    keptfiles = []  # file of every chunk kept by dedup, by kept id
+    dependencies = {}  # file -> files holding the stored copies of its dropped chunks
 
-    for t in texts:
-        print (t,"\n\n")
+    def add_documents(file_path: str, texts: List[Document]):
+        nonlocal produced
+        if dedup is not None:
+            kepttexts = []
+            for t in texts:
+                kept = dedup.check(t.page_content, t.metadata.get("source", file_path))
+                if kept is None:
+                    keptfiles.append(file_path)
+                    kepttexts.append(t)
+                elif keptfiles[kept] != file_path:
+                    dependencies.setdefault(file_path, set()).add(keptfiles[kept])
+            texts = kepttexts
+        ids = [str(uuid.uuid4()) for _ in texts]
+        changed[file_path]["ids"].extend(ids)
+        produced += len(texts)
+        writer.put(texts, ids)
 
+    results = {}
+    failures = []
+    report = {"pages": 0, "seconds": 0.0}
+    pending = list(changed)
+    while pending:
+        produced = 0
+        writer = BatchedStoreWriter(db, settings["embed_batch_size"], settings["embed_queue_size"], settings["log_every"])
+        try:
+            if settings["ingest_async"] or processes is not None:
+                loaded, roundreport = asyncio.run(aload_files(pending, chunk_size, chunk_overlap, settings["ingest_workers"],
+                                                              settings["ingest_concurrency"], settings["ingest_timeout"], cache_directory,
+                                                              add_documents, processes))
+            else:
+                loaded, roundreport = ingest_files(pending, chunk_size, chunk_overlap, settings["ingest_workers"],
+                                                   settings["ingest_timeout"], cache_directory, add_documents)
+        finally:
+            store = writer.close()
+        print_ingest_report(roundreport)
+        print_pipeline_report(roundreport, produced, store)
+        results.update(loaded)
+        failures.extend(roundreport["failed"])
+        report["pages"] += roundreport["pages"]
+        report["seconds"] += roundreport["seconds"]
+        # remove what failed files delivered before failing, they are retried by the next run
+        failed = {file_path for file_path, _ in roundreport["failed"]}
+        partialids = [i for file_path in failed for i in changed[file_path]["ids"]]
+        if partialids:
+            db._collection.delete(ids=partialids)
+        pending = []
+        if dedup is not None and failed:
+            # the files whose dropped chunks were only stored by a failed file (or by a file loaded again because of
+            # that) are loaded again, now compared without the chunks of these files
+            lost = set(failed)
+            while True:
+                more = {file_path for file_path in results if file_path not in lost and dependencies.get(file_path, set()) & lost}
+                if not more:
+                    break
+                lost |= more
+            dedup.forget(kept for kept, file_path in enumerate(keptfiles) if file_path in lost)
+            pending = [file_path for file_path in changed if file_path in lost and file_path not in failed]
+            staleids = [i for file_path in pending for i in changed[file_path]["ids"]]
+            if staleids:
+                db._collection.delete(ids=staleids)
+            for file_path in pending:
+                changed[file_path]["ids"] = []
+                dependencies.pop(file_path, None)
+                del results[file_path]
+            if pending:
+                print(f"Loading {len(pending)} files again, their near-duplicates were stored by failed files")
+    report["loaded"] = len(results)
+    report["failed"] = failures
 
-    # # Create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name, cache_folder=modelstorepath)
-    
-    # Create and store locally vectorstore
-    db = Chroma.from_documents(texts, embeddings, persist_directory=persist_directory, client_settings=CHROMA_SETTINGS)
+    if settings["embedding_cache"]:
+        cache = embeddings.stats()
+        print(f"Embedding cache: {cache['hits']} hits, {cache['misses']} misses, hit rate {cache['hit_rate']:.1%}")
+    if dedup is not None:
+        stats = dedup.stats()
+        print(f"Deduplication: {stats['duplicates']} of {stats['cards']} chunks dropped as near-duplicates")
+        save_duplicates(persist_directory, dedup.merges)
+    evictcache(cache_directory, settings["cache_maxbytes"])
     db.persist()
+    chunks = sum(len(changed[file_path]['ids']) for file_path in results)
+    print(f"Split into {chunks} chunks of text (max. {chunk_size} characters each)")
+
+    for file_path in removed + list(changed):
+        manifest.pop(file_path, None)
+    for file_path in results:
+        manifest[file_path] = changed[file_path]
+        manifest[file_path]["duplicates_of"] = sorted(dependencies.get(file_path, ()))
+    save_manifest(persist_directory, manifest)
+    return {"changed": len(changed), "removed": len(removed), "loaded": report["loaded"], "failed": report["failed"],
+            "pages": report["pages"], "chunks": chunks, "seconds": report["seconds"]}
+
+
+def main():
+    print("Hello")
+    #os.system("pause")
+    # Load environment variables
+    settings = load_settings()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # # Create embeddings
+    embeddings = open_embeddings(settings)
+    # Open the local vectorstore, only new or changed files are loaded, vectors of changed and removed files are replaced
+    db = open_vectorstore(settings["persist_directory"], embeddings)
+    ingest(settings, embeddings, db)
     db = None
 
 
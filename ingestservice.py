@@ -0,0 +1,485 @@
+"""Long-running ingestion service: the worker processes, the embedding model and the vectorstores stay loaded between
+jobs, so small incremental updates do not pay the startup of a fresh exingest.py run.
+
+usage: python ingestservice.py serve [--port 8765 | --socket /tmp/ingest.sock] [--workers 8] [--source-root dir] [--persist-root dir]
+       python ingestservice.py submit ingest [--source-directory docs/] [--priority 0] [--wait]
+       python ingestservice.py submit convert a.pdf notes.txt [--wait]
+       python ingestservice.py status <job id> [--wait]
+       python ingestservice.py metrics
+       python ingestservice.py shutdown
+
+The settings are read from the environment like exingest.py. Jobs run one at a time, by priority (lower first) and
+then in submission order, each job spreads its files over the warm workers. HTTP API on localhost, JSON bodies:
+    POST /jobs {"kind": "ingest" | "convert", "priority": 10, ...}    -> {"id", "queue_depth"}
+    GET  /jobs/<id>[?wait=seconds]                                    -> job state, its result or error once finished
+    GET  /metrics                                                     -> queue depth, job counts and latencies
+    POST /shutdown                                                    -> finishes the running job, cancels the queued ones
+Every request needs the header "Authorization: Bearer <token>", the service writes a new token to the token file
+(default ~/.ingestservice_token, readable by the user only) when it starts and the client commands read it from there.
+POST bodies have to be sent as application/json, so a web page can not post to the service without a CORS preflight.
+Jobs may only name directories and files under the configured source directory and vectorstore (and under the roots
+added with --source-root and --persist-root).
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import queue
+import socket
+import asyncio
+import logging
+import secrets
+import argparse
+import itertools
+import threading
+import socketserver
+import http.client
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# exingest (and through it PyMuPDF and numpy) is imported by the serving side only, the client commands start fast
+
+log = logging.getLogger("ingestservice")
+
+DEFAULTPORT = 8765
+DEFAULTTOKENFILE = os.path.join(os.path.expanduser("~"), ".ingestservice_token")
+DEFAULTPRIORITY = 10
+JOBKINDS = ("ingest", "convert")
+FINISHED = ("done", "failed", "cancelled")
+
+
+class LatencyWindow:
+    # latencies of the last `size` jobs
+
+    def __init__(self, size=1000):
+        self.values = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def summary(self):
+        """
+        :return: {"count", "mean", "p50", "p95", "max"} in seconds, None values if no job finished yet
+        """
+        values = sorted(self.values)
+        if not values:
+            return {"count": 0, "mean": None, "p50": None, "p95": None, "max": None}
+        rank = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+        return {"count": len(values), "mean": sum(values) / len(values), "p50": rank(0.5), "p95": rank(0.95), "max": values[-1]}
+
+
+def writetoken(path):
+    # new random token in a file only the user can read
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.chmod(path, 0o600)  # an existing file keeps its mode
+    return token
+
+
+def readtoken(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def underroots(path, roots):
+    # True if path is one of the roots or inside one, symbolic links and ".." resolved
+    path = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        try:
+            if os.path.commonpath([path, root]) == root:
+                return True
+        except ValueError:  # different drives
+            pass
+    return False
+
+
+def _warmup():
+    # initializer of every pool worker, also of the pools replacing a broken one: the converter and the loaders are
+    # imported before the first file
+    import exingest
+    try:
+        import langchain.document_loaders
+    except ImportError:  # the worker reports it on the first file needing a loader
+        pass
+
+
+class IngestService:
+    """Holds the warm state and runs the queued jobs on a dispatcher thread.
+    An "ingest" job runs exingest.ingest on a source directory (params source_directory, persist_directory, default from
+    the settings), a "convert" job converts a list of files (params files, chunk_size, chunk_overlap) and returns their
+    chunks without storing them. A job with a failed file ends as "failed", its result lists the failed files. The warm
+    workers are replaced when one dies or a file times out (see exingest.WorkerPool), the next job gets a working pool.
+    """
+
+    def __init__(self, settings, workers=None, keepjobs=1000, sourceroots=(), persistroots=()):
+        """
+        :param settings: ingestion settings (see exingest.load_settings)
+        :param workers: number of warm worker processes, default settings["ingest_workers"]
+        :param keepjobs: number of jobs whose state is kept, the oldest finished ones are forgotten first
+        :param sourceroots: directories besides settings["source_directory"] whose files and subdirectories jobs may name
+        :param persistroots: directories besides settings["persist_directory"] jobs may use as vectorstore
+        """
+        self.settings = dict(settings)
+        self.sourceroots = [d for d in (settings["source_directory"], *sourceroots) if d]
+        self.persistroots = [d for d in (settings["persist_directory"], *persistroots) if d]
+        self.workers = workers or settings["ingest_workers"]
+        self.settings["ingest_workers"] = self.workers
+        self.keepjobs = keepjobs
+        self.processes = None
+        self.embeddings = None
+        self.stores = {}  # persist directory -> open vectorstore
+        self.queue = queue.PriorityQueue()  # (priority, sequence, job id)
+        self.sequence = itertools.count()
+        self.jobs = OrderedDict()  # job id -> job dict, in submission order
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # notified when a job finishes
+        self.queued = 0
+        self.running = None
+        self.counts = {"submitted": 0, "done": 0, "failed": 0, "cancelled": 0}
+        self.latency = {"wait": LatencyWindow(), "run": LatencyWindow(), "total": LatencyWindow()}
+        self.started = time.time()
+        self.closed = False
+        self.thread = None
+
+    def start(self):
+        # starts the worker processes, loads the embedding model and opens the default vectorstore before the first job
+        from exingest import WorkerPool, open_embeddings
+        start = time.perf_counter()
+        self.processes = WorkerPool(self.workers, initializer=_warmup)
+        self.processes.executor.submit(os.getpid).result()  # starts the workers
+        self.embeddings = open_embeddings(self.settings)
+        self.vectorstore(self.settings["persist_directory"])
+        self.thread = threading.Thread(target=self._run, name="dispatcher", daemon=True)
+        self.thread.start()
+        log.info("service ready: %d workers in %.1fs", self.workers, time.perf_counter() - start)
+
+    def vectorstore(self, persist_directory):
+        db = self.stores.get(persist_directory)
+        if db is None:
+            from exingest import open_vectorstore
+            db = self.stores[persist_directory] = open_vectorstore(persist_directory, self.embeddings)
+        return db
+
+    def submit(self, kind, priority=DEFAULTPRIORITY, **params):
+        """Queues a job.
+        :param kind: "ingest" or "convert"
+        :param priority: lower runs first, jobs of the same priority run in submission order
+        :param params: parameters of the job
+        :return: job dict
+        """
+        if kind not in JOBKINDS:
+            raise ValueError(f"unknown job kind {kind!r}, expected one of {', '.join(JOBKINDS)}")
+        if kind == "convert" and not params.get("files"):
+            raise ValueError("a convert job needs a list of files")
+        paths = [(path, self.sourceroots) for path in params.get("files") or ()]
+        if params.get("source_directory"):
+            paths.append((params["source_directory"], self.sourceroots))
+        if params.get("persist_directory"):
+            paths.append((params["persist_directory"], self.persistroots))
+        for path, roots in paths:
+            if not isinstance(path, str) or not underroots(path, roots):
+                raise ValueError(f"{path!r} is not under the allowed directories {', '.join(roots)}")
+        job = {"id": uuid.uuid4().hex, "kind": kind, "priority": priority, "params": params, "state": "queued",
+               "submitted": time.time(), "started": None, "finished": None, "result": None, "error": None}
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("service is shutting down")
+            self.jobs[job["id"]] = job
+            self.queued += 1
+            self.counts["submitted"] += 1
+            self._forget()
+        self.queue.put((priority, next(self.sequence), job["id"]))
+        return job
+
+    def status(self, jobid, wait=0.0):
+        """State of a job.
+        :param wait: seconds to wait for the job to finish
+        :return: copy of the job dict, None for an unknown job
+        """
+        deadline = time.monotonic() + wait
+        with self.changed:
+            job = self.jobs.get(jobid)
+            while job is not None and job["state"] not in FINISHED and time.monotonic() < deadline:
+                self.changed.wait(deadline - time.monotonic())
+            return dict(job) if job is not None else None
+
+    def metrics(self):
+        """
+        :return: {"uptime", "workers", "queue_depth", "running", job counts, "latency": {"wait", "run", "total"},
+         "vectorstores"}, wait is the time in the queue, run the time of the job, total both
+        """
+        with self.lock:
+            return {"uptime": time.time() - self.started, "workers": self.workers, "queue_depth": self.queued,
+                    "running": self.running, **self.counts,
+                    "latency": {name: window.summary() for name, window in self.latency.items()},
+                    "vectorstores": list(self.stores)}
+
+    def close(self):
+        # finishes the running job, cancels the queued ones and stops the workers
+        with self.lock:
+            self.closed = True
+        self.queue.put((float("-inf"), -1, None))
+        if self.thread is not None:
+            self.thread.join()
+        with self.changed:
+            for job in self.jobs.values():
+                if job["state"] == "queued":
+                    job["state"] = "cancelled"
+                    self.counts["cancelled"] += 1
+            self.queued = 0
+            self.changed.notify_all()
+        if self.processes is not None:
+            self.processes.shutdown()
+        for db in self.stores.values():
+            db.persist()
+        if hasattr(self.embeddings, "close"):
+            self.embeddings.close()
+
+    def _forget(self):
+        # called with the lock held
+        excess = len(self.jobs) - self.keepjobs
+        for jobid in [jobid for jobid, job in self.jobs.items() if job["state"] in FINISHED][:max(0, excess)]:
+            del self.jobs[jobid]
+
+    def _run(self):
+        while True:
+            _, _, jobid = self.queue.get()
+            if jobid is None:
+                break
+            with self.lock:
+                job = self.jobs[jobid]
+                job["state"] = "running"
+                job["started"] = time.time()
+                self.queued -= 1
+                self.running = jobid
+            try:
+                result, error = self._execute(job), None
+                if result["failed"]:  # the result is kept, it tells which files failed and why
+                    error = f"{len(result['failed'])} files failed"
+            except Exception as e:
+                log.exception("job %s failed", jobid)
+                result, error = None, f"{type(e).__name__}: {e}"
+            with self.changed:
+                job["finished"] = time.time()
+                job["result"], job["error"] = result, error
+                job["state"] = "done" if error is None else "failed"
+                self.counts[job["state"]] += 1
+                self.running = None
+                self.latency["wait"].add(job["started"] - job["submitted"])
+                self.latency["run"].add(job["finished"] - job["started"])
+                self.latency["total"].add(job["finished"] - job["submitted"])
+                self.changed.notify_all()
+            log.info("job %s (%s) %s in %.1fs", jobid, job["kind"], job["state"], job["finished"] - job["started"])
+
+    def _execute(self, job):
+        from exingest import ingest, aload_files, print_ingest_report
+        params = job["params"]
+        if job["kind"] == "ingest":
+            settings = dict(self.settings)
+            settings.update((key, params[key]) for key in ("source_directory", "persist_directory") if params.get(key))
+            return ingest(settings, self.embeddings, self.vectorstore(settings["persist_directory"]), self.processes)
+        results, report = asyncio.run(aload_files(list(params["files"]), params.get("chunk_size", 450), params.get("chunk_overlap", 50),
+                                                  self.workers, self.settings["ingest_concurrency"], self.settings["ingest_timeout"],
+                                                  self.settings["cache_directory"], processes=self.processes))
+        print_ingest_report(report)
+        return {"documents": {file_path: [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+                              for file_path, (docs, _) in results.items()},
+                "failed": report["failed"], "pages": report["pages"], "seconds": report["seconds"]}
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    # JSON API of the service, the server holds the IngestService as server.service
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        # replies 401 unless the request carries the token of the service
+        given = self.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode("utf8"), f"Bearer {self.server.token}".encode("utf8")):
+            return True
+        self.reply(401, {"error": "missing or wrong token"})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path == "/metrics":
+            self.reply(200, service.metrics())
+        elif url.path.startswith("/jobs/"):
+            try:
+                wait = float(parse_qs(url.query).get("wait", ["0"])[0])
+            except ValueError:
+                return self.reply(400, {"error": "wait has to be a number of seconds"})
+            job = service.status(url.path[len("/jobs/"):], wait)
+            self.reply(200, job) if job is not None else self.reply(404, {"error": "unknown job"})
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.headers.get_content_type() != "application/json":
+            return self.reply(415, {"error": "the body has to be application/json"})
+        url = urlsplit(self.path)
+        if url.path == "/jobs":
+            try:
+                params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                job = self.server.service.submit(params.pop("kind", None), int(params.pop("priority", DEFAULTPRIORITY)), **params)
+            except (ValueError, TypeError, AttributeError) as e:
+                return self.reply(400, {"error": str(e)})
+            except RuntimeError as e:
+                return self.reply(503, {"error": str(e)})
+            self.reply(202, {"id": job["id"], "queue_depth": self.server.service.metrics()["queue_depth"]})
+        elif url.path == "/shutdown":
+            self.reply(200, {"state": "shutting down"})
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def address_string(self):
+        # the client address of a unix socket is an empty string
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+if hasattr(socket, "AF_UNIX"):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            if os.path.exists(self.server_address):  # socket of a previous run
+                os.remove(self.server_address)
+            super().server_bind()
+            os.chmod(self.server_address, 0o600)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socketpath, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socketpath = socketpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketpath)
+
+
+def serve(service, port=DEFAULTPORT, socketpath=None, tokenfile=DEFAULTTOKENFILE):
+    """Serves the API until POST /shutdown or ctrl-c, then closes the service.
+    :param service: IngestService, started here
+    :param port: localhost port
+    :param socketpath: unix socket to listen on instead of the port
+    :param tokenfile: file the token of the requests is written to
+    """
+    service.start()
+    server = UnixHTTPServer(socketpath, ServiceRequestHandler) if socketpath else ThreadingHTTPServer(("127.0.0.1", port), ServiceRequestHandler)
+    server.service = service
+    server.token = writetoken(tokenfile)
+    log.info("listening on %s", socketpath or f"http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socketpath and os.path.exists(socketpath):
+            os.remove(socketpath)
+
+
+def request(method, path, body=None, port=DEFAULTPORT, socketpath=None, timeout=None, tokenfile=DEFAULTTOKENFILE):
+    """Calls the API of a running service.
+    :return: HTTP status, decoded JSON response
+    """
+    conn = UnixHTTPConnection(socketpath, timeout) if socketpath else http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request(method, path, body=None if body is None else json.dumps(body),
+                     headers={"Content-Type": "application/json", "Authorization": f"Bearer {readtoken(tokenfile) or ''}"})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        conn.close()
+
+
+def waitforjob(jobid, port=DEFAULTPORT, socketpath=None, tokenfile=DEFAULTTOKENFILE, poll=30.0):
+    # blocks until the job is finished, returns its final state
+    while True:
+        status, job = request("GET", f"/jobs/{jobid}?wait={poll}", port=port, socketpath=socketpath, timeout=poll + 30,
+                              tokenfile=tokenfile)
+        if status != 200 or job["state"] in FINISHED:
+            return status, job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Long-running ingestion service with warm workers and a job queue.")
+    parser.add_argument("--port", type=int, default=DEFAULTPORT, help="localhost port of the service")
+    parser.add_argument("--socket", default=None, help="unix socket of the service instead of the port")
+    parser.add_argument("--token-file", default=DEFAULTTOKENFILE, help="file holding the token of the requests")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serveparser = commands.add_parser("serve", help="run the service")
+    serveparser.add_argument("--workers", type=int, default=None, help="warm worker processes, default INGEST_WORKERS")
+    serveparser.add_argument("--source-root", action="append", default=[], help="further directory jobs may read from")
+    serveparser.add_argument("--persist-root", action="append", default=[], help="further directory jobs may store vectorstores in")
+    submitparser = commands.add_parser("submit", help="queue a job")
+    submitparser.add_argument("kind", choices=JOBKINDS)
+    submitparser.add_argument("files", nargs="*", help="files of a convert job")
+    submitparser.add_argument("--priority", type=int, default=DEFAULTPRIORITY, help="lower runs first")
+    submitparser.add_argument("--source-directory", default=None, help="source directory of an ingest job")
+    submitparser.add_argument("--persist-directory", default=None, help="vectorstore of an ingest job")
+    submitparser.add_argument("--wait", action="store_true", help="wait for the job and print its result")
+    statusparser = commands.add_parser("status", help="state of a job")
+    statusparser.add_argument("id")
+    statusparser.add_argument("--wait", action="store_true", help="wait for the job to finish")
+    commands.add_parser("metrics", help="queue depth, job counts and latencies")
+    commands.add_parser("shutdown", help="stop the service")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    address = {"port": args.port, "socketpath": args.socket, "tokenfile": args.token_file}
+
+    if args.command == "serve":
+        from exingest import load_settings
+        serve(IngestService(load_settings(), args.workers, sourceroots=args.source_root, persistroots=args.persist_root), **address)
+        return 0
+    if args.command == "submit":
+        body = {"kind": args.kind, "priority": args.priority}
+        if args.kind == "convert":
+            body["files"] = [os.path.abspath(f) for f in args.files]
+        # directories are passed as given, the manifest lists the files by their path under the source directory
+        for key in ("source_directory", "persist_directory"):
+            if getattr(args, key):
+                body[key] = getattr(args, key)
+        status, response = request("POST", "/jobs", body, **address)
+        if status == 202 and args.wait:
+            status, response = waitforjob(response["id"], **address)
+    elif args.command == "status":
+        status, response = waitforjob(args.id, **address) if args.wait else request("GET", f"/jobs/{args.id}", **address)
+    elif args.command == "metrics":
+        status, response = request("GET", "/metrics", **address)
+    else:
+        status, response = request("POST", "/shutdown", **address)
+    print(json.dumps(response, indent=1))
+    return 0 if status < 300 and (not isinstance(response, dict) or response.get("state") != "failed") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import re
+from bisect import bisect_right
+
+DIGITS = re.compile(r"\d+")
+MAXMARGINLENGTH = 200  # longer lines are never taken for running headers or footers
+
+
+def pagelines(spans):
+    """Groups the spans of a span table (with text, see extractspantable) into text lines.
+    :param spans: span table
+    :return: {page: list of lines in extraction order}, a line is [x0, y0, x1, y1, block, span indices]
+    """
+    pages = {}
+    line = None
+    previous = None  # line id of the previous span
+    for si, (lineid, (x0, y0, x1, y1)) in enumerate(zip(spans["line"], spans["bbox"])):
+        if lineid != previous:
+            line = [x0, y0, x1, y1, spans["block"][si], []]
+            pages.setdefault(spans["page"][si], []).append(line)
+            previous = lineid
+        else:
+            line[0], line[1], line[2], line[3] = min(line[0], x0), min(line[1], y0), max(line[2], x1), max(line[3], y1)
+        line[5].append(si)
+    return pages
+
+
+def marginkeys(lines, texts):
+    """Keys of the lines in the top and bottom row of a page, the candidates for running headers and footers.
+    The top row are the lines starting above the end of the topmost line, the bottom row likewise. A row only counts
+    if the gap to the rest of the page is larger than the row is high, the first row of a table or paragraph does not.
+    Digits are ignored, so page numbers and dates repeat.
+    :param lines: lines of one page (see pagelines)
+    :param texts: "text" column of the span table
+    :return: {line position: key}
+    """
+    if len(lines) < 2:
+        return {}
+    topend = min(lines, key=lambda l: l[1])[3]
+    bottomstart = max(lines, key=lambda l: l[3])[1]
+    rows = {"top": {i for i, l in enumerate(lines) if l[1] < topend},
+            "bottom": {i for i, l in enumerate(lines) if l[3] > bottomstart}}
+    keys = {}
+    for row, members in rows.items():
+        inside = [l for i, l in enumerate(lines) if i not in members]
+        if not inside:
+            continue
+        y0 = min(lines[i][1] for i in members)
+        y1 = max(lines[i][3] for i in members)
+        gap = min(l[1] for l in inside) - y1 if row == "top" else y0 - max(l[3] for l in inside)
+        if gap <= y1 - y0:
+            continue
+        for i in members:
+            text = " ".join("".join(texts[si] for si in lines[i][5]).split())
+            if text and len(text) <= MAXMARGINLENGTH:
+                keys[i] = (row, round(lines[i][1]), DIGITS.sub("#", text))
+    return keys
+
+
+class RepeatedMargins:
+    """Counts on how many pages each top and bottom row line occurs, lines found on enough pages are running headers
+    and footers (see marginkeys).
+    """
+
+    def __init__(self, minshare=0.25, minpages=3):
+        """
+        :param minshare: share of the counted pages a line has to occur on
+        :param minpages: number of pages a line has to occur on at least
+        """
+        self.minshare = minshare
+        self.minpages = minpages
+        self.pages = 0
+        self.counts = {}
+
+    def add(self, spans):
+        # counts the pages of a span table with text
+        for lines in pagelines(spans).values():
+            for key in set(marginkeys(lines, spans["text"]).values()):
+                self.counts[key] = self.counts.get(key, 0) + 1
+        self.pages += spans["pagecount"] - spans["firstpage"]
+
+    def clear(self):
+        self.pages = 0
+        self.counts = {}
+
+    def keys(self):
+        """
+        :rtype: frozenset
+        :return: keys of the running headers and footers
+        """
+        threshold = max(self.minpages, self.minshare * self.pages)
+        return frozenset(key for key, count in self.counts.items() if count >= threshold)
+
+
+def columngutters(lines, size):
+    """Vertical gutters between text columns of a page, found by a sweep over the x extents of the lines narrower than
+    60% of the content width: a gutter is a gap at least one em wide, covered by less than a tenth of the maximal line
+    height coverage, with columns of at least 10 em width and a quarter of the text of the strongest column on each side.
+    Table columns are mostly narrower than that. O(n log n) in the number of lines.
+    :param lines: lines of one page (see pagelines)
+    :param size: typical font size of the page
+    :return: sorted x positions of the gutter centers
+    """
+    if len(lines) < 2:
+        return []
+    left = min(l[0] for l in lines)
+    right = max(l[2] for l in lines)
+    narrow = [l for l in lines if l[2] - l[0] < 0.6 * (right - left)]
+    events = sorted([(l[0], l[3] - l[1]) for l in narrow] + [(l[2], l[1] - l[3]) for l in narrow])
+    # coverage is the summed height of the narrow lines over x, constant between two events
+    coverage = 0.0
+    steps = []
+    for i, (x, change) in enumerate(events):
+        coverage += change
+        if i + 1 < len(events) and events[i + 1][0] > x:
+            steps.append((x, events[i + 1][0], coverage))
+    if not steps:
+        return []
+    threshold = 0.1 * max(c for _, _, c in steps)
+    gaps = []
+    for x0, x1, c in steps:
+        if c > threshold:
+            continue
+        if gaps and gaps[-1][1] == x0:
+            gaps[-1][1] = x1
+        else:
+            gaps.append([x0, x1])
+    gutters = [(x0 + x1) / 2 for x0, x1 in gaps if x1 - x0 >= size and x0 > events[0][0] and x1 < events[-1][0]]
+    while gutters:
+        bounds = [left] + gutters + [right]
+        weights = [0.0] * (len(gutters) + 1)
+        for l in narrow:
+            weights[bisect_right(gutters, (l[0] + l[2]) / 2)] += l[3] - l[1]
+        failing = [i for i in range(len(weights))
+                   if bounds[i + 1] - bounds[i] < 10 * size or weights[i] < 0.25 * max(weights)]
+        if not failing:
+            break
+        weakest = min(failing, key=lambda i: weights[i])
+        del gutters[weakest - 1 if weakest > 0 else 0]  # merge the column with its left (the first with its right) neighbour
+    return gutters
+
+
+def readingorder(lines, gutters):
+    """Orders the lines of a page by columns. Lines crossing a gutter (titles, full width figures captions) separate
+    sections, within a section the lines are read column by column, in each column in extraction order.
+    :param lines: lines of one page (see pagelines)
+    :param gutters: gutter positions (see columngutters)
+    :return: list of (section, column, line), column is -1 for lines crossing a gutter
+    """
+    if not gutters:
+        return [(0, 0, line) for line in lines]
+    crossing = []
+    for l in lines:
+        g = bisect_right(gutters, l[0])  # first gutter right of the line start
+        crossing.append(g < len(gutters) and gutters[g] < l[2])
+    centers = sorted((l[1] + l[3]) / 2 for l, c in zip(lines, crossing) if c)
+    keys = []
+    for i, (l, c) in enumerate(zip(lines, crossing)):
+        section = bisect_right(centers, (l[1] + l[3]) / 2)
+        keys.append((section, -1 if c else bisect_right(gutters, (l[0] + l[2]) / 2), i))
+    keys.sort()
+    return [(section, column, lines[i]) for section, column, i in keys]
+
+
+def layoutblocks(spans, repeated=frozenset()):
+    """Reading order of the text of a span table: multi-column pages are read column by column and the running
+    headers and footers are dropped. A block whose lines end up in different columns or sections is split.
+    :param spans: span table with text (see extractspantable)
+    :param repeated: margin keys of the running headers and footers (see RepeatedMargins)
+    :return: list of (page, original block, span indices) in reading order
+    """
+    texts = spans["text"]
+    sizes = spans["size"]
+    blocks = []
+    for page, lines in sorted(pagelines(spans).items()):
+        if repeated:
+            dropped = {i for i, key in marginkeys(lines, texts).items() if key in repeated}
+            lines = [line for i, line in enumerate(lines) if i not in dropped]
+        pagesizes = sorted(sizes[line[5][0]] for line in lines)
+        gutters = columngutters(lines, pagesizes[len(pagesizes) // 2]) if pagesizes else []
+        previous = None
+        for section, column, line in readingorder(lines, gutters):
+            if (line[4], section, column) != previous:
+                blocks.append((page, line[4], []))
+                previous = (line[4], section, column)
+            blocks[-1][2].extend(line[5])
+    return blocks
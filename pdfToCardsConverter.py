@@ -1,5 +1,19 @@
 import sys, fitz
+import os
 import re
+import math
+import random
+import logging
+import unicodedata
+from functools import lru_cache
+from contextlib import contextmanager
+import numpy as np
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from conversionprofile import NULLPROFILER
+from pagelayout import RepeatedMargins, layoutblocks
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -12,42 +26,267 @@ def all_equal(iterator):
     return all(first == x for x in iterator)
 
 
+# text only: the "dict" flags without TEXT_PRESERVE_IMAGES, MuPDF does not decode and copy the image data into type 1 blocks
+TEXTFLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+def extractionprofile(preserveligatures=True, preservewhitespace=True, clip=None, skipnotext=True):
+    """Options of the page text extraction, pass the result as extraction= (None is the default profile).
+    :param preserveligatures: keep ligatures like \ufb01 as one character, False lets MuPDF expand them
+    :param preservewhitespace: keep tabs and other whitespace characters, False lets MuPDF turn them into spaces
+    :param clip: only extract the text inside this rectangle (x0, y0, x1, y1) of every page, e.g. to leave out the margins
+    :param skipnotext: pdf pages without any font have no text layer (scans, image pages), they are not decoded
+    :rtype: dict
+    :return: {"flags", "clip", "skipnotext"}
+    """
+    flags = TEXTFLAGS
+    if not preserveligatures:
+        flags &= ~fitz.TEXT_PRESERVE_LIGATURES
+    if not preservewhitespace:
+        flags &= ~fitz.TEXT_PRESERVE_WHITESPACE
+    return {"flags": flags, "clip": clip, "skipnotext": skipnotext}
+
+DEFAULTEXTRACTION = extractionprofile()
+
+def pagetextblocks(page, extraction=None):
+    """Blocks of page.get_text("dict") with the flags of the extraction profile, text blocks only.
+    :param page: page of a document
+    :param extraction: extraction profile (see extractionprofile), None is the default profile
+    :return: list of blocks, None for a page without text layer that was not decoded
+    """
+    extraction = extraction or DEFAULTEXTRACTION
+    if extraction["skipnotext"] and page.parent.is_pdf and not page.get_fonts():
+        return None
+    return page.get_text("dict", flags=extraction["flags"], clip=extraction["clip"])["blocks"]
+
+def extractspantable(doc, withtext=True, extraction=None):
+    """Decodes every page of the document once into a compact, column oriented span table.
+    All conversion stages read from this table, so page.get_text("dict") runs once per page.
+    :param doc: PDF document to iterate through
+    :type doc: <class 'fitz.fitz.Document'>
+    :param withtext: False leaves the "text", "bbox" and "line" columns empty, enough for the font and color statistics
+    :param extraction: extraction profile (see extractionprofile)
+    :rtype: dict
+    :return: span columns "text","space","size","font","flags","color","bbox","page","block","line" (one entry per span),
+     block columns "blockpage","blockuniform" (one entry per text block), "firstpage", "pagecount" and "skippedpages",
+     the number of pages without text layer
+    """
+    spans = newspantable()
+    for pno, page in enumerate(doc):
+        appendpagetospantable(spans, pagetextblocks(page, extraction), pno, withtext)
+    return spans
+
+def iterspantablepages(doc, pages=None, extraction=None):
+    """Yields one span table per page, so the text of the document is never held at once.
+    :param doc: PDF document to iterate through
+    :type doc: <class 'fitz.fitz.Document'>
+    :param pages: page numbers (0 based) to decode, None decodes every page
+    :param extraction: extraction profile (see extractionprofile)
+    :return: generator of span tables
+    """
+    for pno in range(doc.page_count) if pages is None else pages:
+        yield appendpagetospantable(newspantable(pno), pagetextblocks(doc[pno], extraction), pno)
+
+def newspantable(firstpage=0):
+    # helper function for extractspantable, creates an empty span table starting at page firstpage
+    return {"text": [], "space": [], "size": [], "font": [], "flags": [], "color": [], "bbox": [], "page": [], "block": [],
+            "line": [], "blockpage": [], "blockuniform": [], "firstpage": firstpage, "pagecount": firstpage, "skippedpages": 0}
+
+def appendpagetospantable(spans, blocks, pno, withtext=True):
+    # helper function for extractspantable, adds the text blocks of one page to the span table, blocks is None for a
+    # page skipped by pagetextblocks
+    if blocks is None:
+        spans["skippedpages"] += 1
+        blocks = []
+    fontlist = []
+    colorlist = []
+    lineid = spans["line"][-1] if spans["line"] else -1
+    for b in blocks:
+        if b['type'] == 0:  # this block contains text
+            blockid = len(spans["blockpage"])
+            #only apply size augmentation of entire line has the same properties (last line of the block decides)
+            for l in b['lines']:
+                fontlist=[s['font'] for s in l["spans"] if not s['text'].isspace() and not "@" in s['text']]
+                colorlist=[s['color'] for s in l["spans"]if not s['text'].isspace() and not "@" in s['text']]
+            spans["blockpage"].append(pno)
+            spans["blockuniform"].append(all_equal(fontlist) and all_equal(colorlist))
+            for l in b['lines']:
+                lineid += 1
+                for s in l["spans"]:
+                    if withtext:
+                        spans["text"].append(s['text'])
+                        spans["bbox"].append(tuple(s['bbox']))
+                        spans["line"].append(lineid)
+                    spans["space"].append(s['text'].isspace())
+                    spans["size"].append(s['size'])
+                    spans["font"].append(s['font'])
+                    spans["flags"].append(s['flags'])
+                    spans["color"].append(s['color'])
+                    spans["page"].append(pno)
+                    spans["block"].append(blockid)
+    spans["pagecount"] = max(spans["pagecount"], pno + 1)
+    return spans
+
+
+def extractspantablerange(pdfpath, start, stop, extraction=None):
+    """Extracts the span table for the pages start..stop-1 with its own document handle, used by the worker processes.
+    :param pdfpath: path to pdf
+    :param start: first page (0 based)
+    :param stop: page after the last page
+    :rtype: dict
+    :return: span table of the page range, page numbers are absolute
+    """
+    spans = newspantable(start)
+    with fitz.open(pdfpath) as doc:
+        for pno in range(start, stop):
+            appendpagetospantable(spans, pagetextblocks(doc[pno], extraction), pno)
+    return spans
+
+def mergespantables(tables):
+    """Concatenates span tables of consecutive page ranges in page order.
+    :param tables: list of span tables, ordered by page
+    :rtype: dict
+    :return: span table of the whole range
+    """
+    spans = newspantable(tables[0]["firstpage"] if tables else 0)
+    for t in tables:
+        blockoffset = len(spans["blockpage"])
+        lineoffset = spans["line"][-1] + 1 if spans["line"] else 0
+        for key in ("text", "space", "size", "font", "flags", "color", "bbox", "page", "blockpage", "blockuniform"):
+            spans[key].extend(t[key])
+        spans["block"].extend(b + blockoffset for b in t["block"])
+        spans["line"].extend(l + lineoffset for l in t["line"])
+        spans["pagecount"] = max(spans["pagecount"], t["pagecount"])
+        spans["skippedpages"] += t["skippedpages"]
+    return spans
+
+def extractspantableparallel(pdfpath, workers, pagecount=None, extraction=None):
+    """Same result as extractspantable, but page ranges are extracted in worker processes.
+    :param pdfpath: path to pdf
+    :param workers: number of worker processes
+    :param pagecount: number of pages of the document, read from the pdf if not given
+    :param extraction: extraction profile (see extractionprofile)
+    :rtype: dict
+    :return: span table of the document
+    """
+    if pagecount is None:
+        with fitz.open(pdfpath) as doc:
+            pagecount = doc.page_count
+    chunks = max(1, min(pagecount, workers * 4))  # a few ranges per worker to even out slow pages
+    bounds = [pagecount * i // chunks for i in range(chunks + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        tables = list(pool.map(extractspantablerange, [pdfpath] * chunks, bounds[:-1], bounds[1:], [extraction] * chunks))
+    return mergespantables(tables)
+
+def opendocument(pdf):
+    """Opens a pdf given by its path or by its content in memory.
+    :param pdf: path, or the content as bytes, bytearray, memoryview or mmap. The content is handed to MuPDF without a copy
+     and must not change while the document is open
+    :return: fitz.Document, close it with documentclosing
+    """
+    if isinstance(pdf, (str, os.PathLike)):
+        return fitz.open(pdf)
+    return fitz.open(stream=pdf if isinstance(pdf, bytes) else memoryview(pdf), filetype="pdf")
+
+def sourcename(pdf, source=None):
+    # name of the pdf in the card metadata, in-memory content has no path
+    if source is not None:
+        return source
+    return os.fspath(pdf) if isinstance(pdf, (str, os.PathLike)) else "<memory>"
+
+@contextmanager
+def documentclosing(doc, storemaxsize=None):
+    """Closes the document when the block (or the generator using it) ends, also on errors.
+    :param doc: PDF document
+    :param storemaxsize: afterwards shrink the MuPDF store to this many bytes (see limitstore), None leaves it alone
+    """
+    try:
+        yield doc
+    finally:
+        doc.close()
+        if storemaxsize is not None:
+            limitstore(storemaxsize)
+
+def limitstore(storemaxsize):
+    """Shrinks the MuPDF store, the fonts, images and objects MuPDF caches for all documents of the process, to at most
+    storemaxsize bytes. Keeps the memory of long running workers bounded. PyMuPDF versions that do not report the store
+    size (TOOLS.store_size is None) get the store emptied.
+    :param storemaxsize: bytes
+    """
+    size = fitz.TOOLS.store_size
+    size = size() if callable(size) else size  # a property in older PyMuPDF versions
+    if size is None or storemaxsize <= 0:
+        fitz.TOOLS.store_shrink(100)
+    elif size > storemaxsize:
+        fitz.TOOLS.store_shrink(math.ceil(100 * (size - storemaxsize) / size))
+
+def layoutspantable(spans, repeated=frozenset()):
+    """Span table in reading order: the lines of multi-column pages are reordered column by column and the running headers
+    and footers are dropped (see pagelayout.layoutblocks).
+    :param spans: span table with text (see extractspantable)
+    :param repeated: margin keys of the running headers and footers (see pagelayout.RepeatedMargins)
+    :rtype: dict
+    :return: new span table, blocks split across columns become several blocks
+    """
+    ordered = newspantable(spans["firstpage"])
+    ordered["pagecount"] = spans["pagecount"]
+    for pno, block, spanindices in layoutblocks(spans, repeated):
+        blockid = len(ordered["blockpage"])
+        ordered["blockpage"].append(pno)
+        ordered["blockuniform"].append(spans["blockuniform"][block])
+        for si in spanindices:
+            for key in ("text", "space", "size", "font", "flags", "color", "bbox", "page", "line"):
+                ordered[key].append(spans[key][si])
+            ordered["block"].append(blockid)
+    return ordered
+
+def getspancolumns(spans):
+    """NumPy columns of the span table, font and color as categorical codes. Cached in the table under "columns".
+    :param spans: span table (see extractspantable)
+    :rtype: dict
+    :return: arrays "size","flags","space","block","blockuniform","font","color" and the code lists "fonts","colors"
+    """
+    columns = spans.get("columns")
+    if columns is not None and len(columns["size"]) == len(spans["size"]):
+        return columns
+    fontcodes = {}
+    colorcodes = {}
+    n = len(spans["size"])
+    columns = {
+        "size": np.asarray(spans["size"], dtype=np.float64).reshape(n),
+        "flags": np.asarray(spans["flags"], dtype=np.int64).reshape(n),
+        "space": np.asarray(spans["space"], dtype=bool).reshape(n),
+        "block": np.asarray(spans["block"], dtype=np.int64).reshape(n),
+        "blockuniform": np.asarray(spans["blockuniform"], dtype=bool),
+        "font": np.fromiter((fontcodes.setdefault(f, len(fontcodes)) for f in spans["font"]), dtype=np.int64, count=n),
+        "color": np.fromiter((colorcodes.setdefault(c, len(colorcodes)) for c in spans["color"]), dtype=np.int64, count=n),
+    }
+    columns["fonts"] = list(fontcodes)
+    columns["colors"] = list(colorcodes)
+    spans["columns"] = columns
+    return columns
+
 def getweightedfontncolorstatisticsofdoc(doc):
     """PDF statistics regarding font and color
-    :param page: page of docment
+    :param doc: PDF document or span table (see extractspantable)
     :return: {font:count}{color:count}
     """
-    colorstats={}
-    fontstats={}
-    linecount=0.0
-    for page in doc:
-        blocks= page.get_text("dict")["blocks"]
-        
-        #get statistics of color and fonts 
-        for b in blocks:
-            if b["type"] == 0:  # this block contains text
-                for l in b["lines"]:
-                    for s in l["spans"]:
-                        if not s['text'].isspace():#do not count empty text elements
-                            if s['color'] in colorstats:
-                                colorstats[s['color']]=colorstats[s['color']]+1
-                            else:
-                                colorstats[s['color']]=1.0
-                            if s['font'] in fontstats:
-                                fontstats[s['font']]=fontstats[s['font']]+1
-                            else:
-                                fontstats[s['font']]=1.0
-                                #artificially increase the size of the element
-                            linecount+=1
+    spans = doc if isinstance(doc, dict) else extractspantable(doc)
+    columns = getspancolumns(spans)
+
+    #get statistics of color and fonts, do not count empty text elements
+    counted = ~columns["space"]
+    linecount = float(np.count_nonzero(counted))
+    if linecount == 0:
+        return {}, {}
+    fontcounts = np.bincount(columns["font"][counted], minlength=len(columns["fonts"]))
+    colorcounts = np.bincount(columns["color"][counted], minlength=len(columns["colors"]))
     #calcstatistics
-    for k,c in colorstats.items():
-        colorstats[k]=c/linecount
-    for r,sq in fontstats.items():
-        fontstats[r]=sq/linecount
+    fontstats = {columns["fonts"][k]: c for k, c in enumerate((fontcounts / linecount).tolist()) if fontcounts[k]}
+    colorstats = {columns["colors"][k]: c for k, c in enumerate((colorcounts / linecount).tolist()) if colorcounts[k]}
 
     return fontstats,colorstats
 
-def getblockswithgranularityColorFont(page,fontstats,colorstats,usefontsNcolor):
+def getblockswithgranularityColorFont(page,fontstats,colorstats,usefontsNcolor, extraction=None):
     """Extracts blocks using color and font in addition to size.
     :param page: page of doc
     :param fontstats: statistics of the fonts
@@ -55,12 +294,13 @@ def getblockswithgranularityColorFont(page,fontstats,colorstats,usefontsNcolor):
     :type doc: <class 'fitz.fitz.Document'>
     :param granularity: also use 'font', 'flags' and 'color' to discriminate text
     :type granularity: bool
+    :param extraction: extraction profile (see extractionprofile), the default one leaves out the image blocks
     :rtype: page blocks 
     :return: blocks
     """
     rat = 1.618*1
     if usefontsNcolor:
-        blocks= page.get_text("dict")["blocks"]
+        blocks= pagetextblocks(page, extraction) or []
 
         #augment the font sizes
         for b in blocks:
@@ -83,44 +323,74 @@ def getblockswithgranularityColorFont(page,fontstats,colorstats,usefontsNcolor):
                  
         return blocks
     else:
-        return page.get_text("dict")["blocks"]
+        return pagetextblocks(page, extraction) or []
 
     #go through blocks and if color != 
 
+def getspansizeswithgranularityColorFont(spans,fontstats,colorstats,usefontsNcolor):
+    """Same size augmentation as getblockswithgranularityColorFont, computed on the span table.
+    :param spans: span table (see extractspantable)
+    :param fontstats: statistics of the fonts
+    :param colorstats: statistics of the color
+    :param usefontsNcolor: also use 'font' and 'color' to discriminate text
+    :rtype: list
+    :return: augmented size for every span of the table
+    """
+    if not usefontsNcolor:
+        return spans["size"]
+    columns = getspancolumns(spans)
+    size = columns["size"]
+    # fonts and colors only used by whitespace spans have no statistics, their spans are never augmented
+    fontshare = np.array([fontstats.get(f, np.nan) for f in columns["fonts"]], dtype=np.float64)
+    colorshare = np.array([colorstats.get(c, np.nan) for c in columns["colors"]], dtype=np.float64)
+    augment = columns["blockuniform"][columns["block"]] & ~columns["space"]
+    squared = size*size
+    # same operation order as the per span formula, so the results are bit identical
+    augmented = squared + squared*(1/fontshare[columns["font"]]) + size*0.5*(1/colorshare[columns["color"]])
+    return np.where(augment, augmented, squared).tolist()
+
 
 def fonts(doc,fontstats,colorstats,usefontsNcolor):
     """Extracts fonts and their usage in PDF documents.
-    :param doc: PDF document to iterate through
-    :type doc: <class 'fitz.fitz.Document'>
+    :param doc: PDF document or span table (see extractspantable)
+    :type doc: <class 'fitz.fitz.Document'> or dict
     :param granularity: also use 'font', 'flags' and 'color' to discriminate text
     :type granularity: bool
     :rtype: [(font_size, count), (font_size, count}], dict
     :return: most used fonts sorted by count, font style information
     """
-    styles = {}
-    font_counts = {}
-
-    for page in doc:
-        #blocks = page.get_text("dict")["blocks"]
-        blocks = getblockswithgranularityColorFont(page, fontstats,colorstats,usefontsNcolor)
-        for b in blocks:  # iterate through the text blocks
-            if b['type'] == 0:  # block contains text
-                for l in b["lines"]:  # iterate through the text lines
-                    for s in l["spans"]:  # iterate through the text spans
-                        if usefontsNcolor:
-                            identifier = "{0}_{1}_{2}_{3}".format(s['size'], s['flags'], s['font'], s['color'])
-                            styles[identifier] = {'size': s['size'], 'flags': s['flags'], 'font': s['font'],
-                                                  'color': s['color']}
-                        else:
-                            identifier = "{0}".format(s['size'])
-                            styles[identifier] = {'size': s['size'], 'font': s['font']}
+    spans = doc if isinstance(doc, dict) else extractspantable(doc)
+    sizes = getspansizeswithgranularityColorFont(spans, fontstats,colorstats,usefontsNcolor)
+    columns = getspancolumns(spans)
+    if len(sizes) < 1:
+        raise ValueError("Zero discriminating fonts found!")
 
-                        font_counts[identifier] = font_counts.get(identifier, 0) + 1  # count the fonts usage
+    # one group per distinct style, counted in bulk on a single integer key (sorting int64 is much faster than records)
+    _, keys = np.unique(np.asarray(sizes, dtype=np.float64), return_inverse=True)
+    keys = keys.reshape(-1).astype(np.int64)
+    if usefontsNcolor:
+        flagvalues, flagcodes = np.unique(columns["flags"], return_inverse=True)
+        keys = ((keys*len(flagvalues) + flagcodes.reshape(-1))*len(columns["fonts"]) + columns["font"])*len(columns["colors"]) + columns["color"]
+    _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    # groups in order of first appearance, then by count (stable, like sorted on a dict)
+    order = np.argsort(first, kind="stable")
+    first, counts = first[order], counts[order]
 
-    font_counts = sorted(font_counts.items(), key=lambda ele:ele[1], reverse=True) #fo whatever reason, get the second element as key (passed as a function)
+    styles = {}
+    font_counts = []
+    for i, count in zip(first.tolist(), counts.tolist()):
+        size, font = sizes[i], spans["font"][i]
+        if usefontsNcolor:
+            flags, color = spans["flags"][i], spans["color"][i]
+            identifier = "{0}_{1}_{2}_{3}".format(size, flags, font, color)
+            styles[identifier] = {'size': size, 'flags': flags, 'font': font,
+                                  'color': color}
+        else:
+            identifier = "{0}".format(size)
+            styles[identifier] = {'size': size, 'font': font}
+        font_counts.append((identifier, count))
 
-    if len(font_counts) < 1:
-        raise ValueError("Zero discriminating fonts found!")
+    font_counts = sorted(font_counts, key=lambda ele:ele[1], reverse=True) #fo whatever reason, get the second element as key (passed as a function)
 
     return font_counts, styles
 
@@ -137,91 +407,141 @@ def font_tags(font_counts, styles):
     p_size = p_style['size']  # get the paragraph's size
 
     # sorting the font sizes high to low, so that we can append the right integer to each tag 
-    font_sizes = []
+    font_sizes = np.array([styles[font_size]['size'] if font_size in styles else float(font_size.split("_")[0])
+                           for (font_size, count) in font_counts], dtype=np.float64)
+    font_sizes = -np.sort(-font_sizes)
+    logger.debug('font sizes: %s', font_sizes.tolist())
 
-    #print("font_counts:",font_counts)
-    for (font_size, count) in font_counts:
-        #print("fontsize:",font_size, " count:", count)
-        if "_"in font_size: #special handling if granularity in function fonts is set to true
-            font_sizes.append(float(font_size.split("_")[0]))
-        else:
-            font_sizes.append(float(font_size))
-
-    font_sizes.sort(reverse=True)
-    print('font sizes\n:',font_sizes)
-    # aggregating the tags for each font size
-    idx = 0
+    # aggregating the tags for each font size: a size gets the tag of its last position in the sorted list,
+    # headings are numbered from the top, smaller sizes from the last paragraph size
+    distinct, first = np.unique(font_sizes[::-1], return_index=True)
+    last = len(font_sizes) - 1 - first
+    below = np.flatnonzero(font_sizes == p_size)
+    lastp = below[-1] if len(below) else -1
     size_tag = {}
-    for size in font_sizes:
-        idx += 1
+    for size, position in sorted(zip(distinct.tolist(), last.tolist()), reverse=True):
         if size == p_size:
-            idx = 0
             size_tag[size] = '<p>'
-        if size > p_size:
-            size_tag[size] = '<h{0}>'.format(idx)
+        elif size > p_size:
+            size_tag[size] = '<h{0}>'.format(position + 1)
         elif size < p_size:
-            size_tag[size] = '<s{0}>'.format(idx)
+            size_tag[size] = '<s{0}>'.format(position - lastp)
 
     return size_tag
 
+class TaggedElement:
+    """Element of the stream between headers_para and buildcards.
+    kind is "page" for a page marker, otherwise the tag letter "h", "p" or "s" with its level (None for "p"),
+    page is the 0 based page number, text the element text ("Page N" for page markers) and bbox the
+    union of the span boxes (x0, y0, x1, y1) or None.
+    """
+    __slots__ = ("kind", "level", "page", "text", "bbox")
+
+    def __init__(self, kind, level, page, text, bbox=None):
+        self.kind = kind
+        self.level = level
+        self.page = page
+        self.text = text
+        self.bbox = bbox
+
+    def __repr__(self):
+        return "TaggedElement({0!r}, {1!r}, {2!r}, {3!r}, {4!r})".format(self.kind, self.level, self.page, self.text, self.bbox)
+
+    def __eq__(self, other):
+        return isinstance(other, TaggedElement) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+def elementtostring(element):
+    """Serializes an element into the html-ish text format, e.g. "<h2>Title" or "<-Page 5>".
+    :param element: TaggedElement
+    :rtype: str
+    """
+    if element.kind == "page":
+        return "<-" + element.text + ">"
+    return "<" + element.kind + ("" if element.level is None else str(element.level)) + ">" + element.text
+
+def parsetag(tag):
+    # helper function, "<h2>" -> ("h", 2), "<p>" -> ("p", None)
+    level = tag[2:-1]
+    return tag[1:2], int(level) if level else None
+
 def headers_para(doc, size_tag,fontstats,colorstats,usefontsNcolor):
     """Scrapes headers & paragraphs from PDF and return texts with element tags.
-    :param doc: PDF document to iterate through
-    :type doc: <class 'fitz.fitz.Document'>
+    :param doc: PDF document or span table (see extractspantable)
+    :type doc: <class 'fitz.fitz.Document'> or dict
     :param size_tag: textual element tags for each size
     :adds pagemarker PJ
     :type size_tag: dict
     :rtype: list
     :return: texts with pre-prended element tags
     """
-    header_para = []  # list with headers and paragraphs
-    first = True  # boolean operator for first header
-    previous_s = {}  # previous span
-    pcount=1
-
-    for page in doc:
-        header_para.append("<-Page "+str(pcount)+">")
-        pcount+=1
-        #blocks = page.get_text("dict")["blocks"]
-        blocks = getblockswithgranularityColorFont(page, fontstats,colorstats,usefontsNcolor)
-        for b in blocks:  # iterate through the text blocks
-            if b['type'] == 0:  # this block contains text
-                #print("block:",b)
-                # REMEMBER: multiple fonts and sizes are possible IN one block
+    spans = doc if isinstance(doc, dict) else extractspantable(doc)
+    return list(iterheaders_para([spans], size_tag,fontstats,colorstats,usefontsNcolor))
 
-                block_string = ""  # text found in block
-                for l in b["lines"]:  # iterate through the text lines
-                    for s in l["spans"]:  # iterate through the text spans
-                        if s['text'].strip():  # removing whitespaces:
-                            #print("block:",b,"\n")
-                            if first:
-                                previous_s = s
-                                first = False
-                                block_string = size_tag[s['size']] + s['text']
-                            else:
-                                if s['size'] == previous_s['size']: # connect all elements as long as they are of the same size
+def iterheaders_para(tables, size_tag,fontstats,colorstats,usefontsNcolor):
+    """Generator version of headers_para, yields the tagged texts of consecutive span tables (e.g. one per page).
+    :param tables: iterable of span tables in page order
+    :param size_tag: textual element tags for each size
+    :return: texts with pre-prended element tags
+    """
+    return map(elementtostring, iterelements(tables, size_tag,fontstats,colorstats,usefontsNcolor))
 
-                                    if block_string and all((c == "|") for c in block_string):
-                                        # block_string only contains pipes
-                                        block_string = size_tag[s['size']] + s['text']
-                                    if block_string == "":
-                                        # new block has started, so append size tag
-                                        block_string = size_tag[s['size']] + s['text']
-                                    else:  # in the same block, so concatenate strings
-                                        block_string += " " + s['text']
+class UnseenStyleError(KeyError):
+    # a span size without tag, raised by iterelements when the styles were estimated from a page sample
+    def __init__(self, size, page):
+        KeyError.__init__(self, size)
+        self.size = size
+        self.page = page
 
-                                else: # this code only switches size tag if size changes, independent of the the color etc. 
-                                    header_para.append(block_string)
-                                    block_string = size_tag[s['size']] + s['text']
+def iterelements(tables, size_tag,fontstats,colorstats,usefontsNcolor):
+    """Scrapes headers & paragraphs of consecutive span tables into a stream of TaggedElement.
+    Spans are joined into one element as long as they are in the same block and of the same size.
+    :param tables: iterable of span tables in page order
+    :param size_tag: textual element tags for each size
+    :return: generator of TaggedElement, a page marker starts every page
+    """
+    tags = {tag: parsetag(tag) for tag in set(size_tag.values())}
+    size_kindlevel = {size: tags[tag] for size, tag in size_tag.items()}
+    previous_size = None  # size of previous span
 
-                                previous_s = s
+    for spans in tables:
+        sizes = getspansizeswithgranularityColorFont(spans, fontstats,colorstats,usefontsNcolor)
+        texts = spans["text"]
+        bboxes = spans["bbox"]
+        blockof = spans["block"]
+        blockpage = spans["blockpage"]
+        si = 0  # span index
+        bi = 0  # text block index
 
-                    # new block started, indicating with a pipe
-                    #block_string += "|"
+        for pno in range(spans["firstpage"], spans["pagecount"]):
+            yield TaggedElement("page", None, pno, "Page "+str(pno+1))
+            while bi < len(blockpage) and blockpage[bi] == pno:  # iterate through the text blocks of the page
+                # REMEMBER: multiple fonts and sizes are possible IN one block
 
-                header_para.append(block_string)
+                parts = []  # text found in block, joined once the element is finished
+                while si < len(texts) and blockof[si] == bi:  # iterate through the text spans of the block
+                    text = texts[si]
+                    size = sizes[si]
+                    x0, y0, x1, y1 = bboxes[si]
+                    si += 1
+                    if text.strip():  # removing whitespaces:
+                        if parts and size == previous_size:  # connect all elements as long as they are of the same size
+                            parts.append(" ")
+                            parts.append(text)
+                            bx0, by0, bx1, by1 = min(bx0, x0), min(by0, y0), max(bx1, x1), max(by1, y1)
+                        else: # this code only switches size tag if size changes, independent of the the color etc. 
+                            if parts:
+                                yield TaggedElement(kind, level, pno, "".join(parts), (bx0, by0, bx1, by1))
+                            try:
+                                kind, level = size_kindlevel[size]
+                            except KeyError:  # only possible with styles estimated from a page sample
+                                raise UnseenStyleError(size, pno) from None
+                            parts = [text]
+                            bx0, by0, bx1, by1 = x0, y0, x1, y1
+                        previous_size = size
 
-    return header_para
+                if parts:
+                    yield TaggedElement(kind, level, pno, "".join(parts), (bx0, by0, bx1, by1))
+                bi += 1
 
 
 #def turntexttocards(headerspara,chunksize=500,overlap=50):
@@ -243,101 +563,250 @@ def buildcards(headerspara, filename,headerdepth):
     :param headerdepth: lvl of header which shall be includd in the title of a text block e.g. 4 means up to <h4>
     :return: "cards" with a [{"page_content": text, "metadata":{"source":, "title"}} ]
     """
-    validheaders=[]
-    i=0
-    while i<=headerdepth: 
-        validheaders.append("")
-        i+=1
+    return list(iterbuildcards(headerspara, filename,headerdepth))
+
+def iterbuildcards(headerspara, filename,headerdepth):
+    """Generator version of buildcards, yields every card as soon as its heading section or page is closed.
+    :param headerspara: iterable of texts with html header markings
+    :param filename: name of the pdf file processed / source
+    :param headerdepth: lvl of header which shall be includd in the title of a text block e.g. 4 means up to <h4>
+    :return: "cards" {"page_content": text, "metadata":{"source":, "title"}}
+    """
+    return iterbuildcardsfromelements(parsetaggedtext(headerspara), filename,headerdepth)
+
+def iterbuildcardsfromelements(elements, filename,headerdepth, validheaders=None):
+    """Same as iterbuildcards, but for a stream of TaggedElement (see iterelements).
+    :param elements: iterable of TaggedElement
+    :param filename: name of the pdf file processed / source
+    :param headerdepth: lvl of header which shall be includd in the title of a text block e.g. 4 means up to <h4>
+    :param validheaders: headers in effect before the first element (see headingcontext), None starts without headers
+    :return: "cards" {"page_content": text, "metadata":{"source":, "title"}}
+    """
+    if validheaders is not None:
+        validheaders=list(validheaders)
+    else:
+        validheaders=[]
+        i=0
+        while i<=headerdepth: 
+            validheaders.append("")
+            i+=1
     metadata=[]
     metadata.append(filename)
     metadata.append([])
-    cards=[]
-    block={}
-    text=""
-    blocktext=""
-    for ele in headerspara:
+    blockparts=[]  # text of the current card, joined once the card is finished
+    for element in elements:
+        text = element.text
         
         #handle the page metadata, split the block on pagebreak
-        if "<-Page " in ele:
+        if element.kind == "page":
             
             # finish previous card
-            cards.append(finishcard(validheaders,metadata,blocktext))
+            yield finishcard(validheaders,metadata,"".join(blockparts))
             #reset 
-            blocktext=""
+            blockparts=[]
 
             #set the page
-            metadata[1]=ele.replace("-","").replace("<","").replace(">","")
+            metadata[1]=text
             continue
 
-        if '>' not in ele:
-            continue
         #handle header
         #if new detected, start a new block, close the old one and append it, ignore everything 
-    
-        rawdem,text = ele.split(">",1)
-        
-        denominator =re.sub("[^0-9]", "", rawdem)
 
         #split at header
-        if denominator !="" and denominator.isnumeric() and "<h" in rawdem and int(denominator)<=headerdepth and "@" not in text:
+        level = element.level
+        if element.kind == "h" and level is not None and level<=headerdepth and "@" not in text:
             # finish previous card
-            denominator = int(denominator)
-            
-            cards.append(finishcard(validheaders,metadata,blocktext))
+            yield finishcard(validheaders,metadata,"".join(blockparts))
             #reset 
-            blocktext=""
+            blockparts=[]
             #set the header
-            validheaders[denominator]=text
+            validheaders[level]=text
             #clear all lower headers
-            i=denominator+1
+            i=level+1
             while i<=headerdepth: 
                 validheaders[i]=""
                 i+=1  
             text=""
 
-        blocktext=blocktext +" "+text
+        blockparts.append(" ")
+        blockparts.append(text)
 
     #in the last step, if there is still data left in the blocktext, then it needs to be added to the last card
-    if len(blocktext)>0:
-        cards.append(finishcard(validheaders,metadata,blocktext))
-    return cards
+    if blockparts:
+        yield finishcard(validheaders,metadata,"".join(blockparts))
 
-def splitcards(cards,maxcardcharacterlength,overlap):
-    # split card page content to ensure a mximum text length with an overlap to previous text
+def parsetaggedtext(headerspara):
+    """Parses tagged texts into TaggedElement, the tags are parsed once per distinct tag.
+    :param headerspara: iterable of texts with html header markings
+    :return: generator of TaggedElement, texts without tag are skipped. The page is only known for page markers.
+    """
+    tags = {}  # raw tag -> (kind, heading level or None)
+    page = None
+    for ele in headerspara:
+        if "<-Page " in ele:
+            text = ele.replace("-","").replace("<","").replace(">","")
+            digits = re.sub("[^0-9]", "", text)
+            page = int(digits) - 1 if digits else None
+            yield TaggedElement("page", None, page, text)
+            continue
+        if '>' not in ele:
+            continue
+        rawdem,text = ele.split(">",1)
+        if rawdem in tags:
+            kind, level = tags[rawdem]
+        else:
+            denominator =re.sub("[^0-9]", "", rawdem)
+            if denominator !="" and denominator.isnumeric() and "<h" in rawdem:
+                kind, level = "h", int(denominator)
+            else:
+                kind, level = rawdem[1:2], int(denominator) if denominator else None
+            tags[rawdem] = kind, level
+        yield TaggedElement(kind, level, page, text)
+
+def splitcards(cards,maxcardcharacterlength,overlap, compat=True, sentences=False, maxtokens=None):
+    """split card page content to ensure a mximum text length with an overlap to previous text
+    :param cards: cards to split
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param compat: cut at the same positions as the original character by character splitter (see compatsplitranges)
+    :param sentences: prefer to cut at the end of a sentence, only without compat
+    :param maxtokens: max number of whitespace separated words per card in addition to the character limit, only without compat
+    :return: split cards, every split card is a copy of its original card with a part of the page content
+    """
     result = []
     keytobesplit='page_content'
     for card in cards:
-        value =""
         value = card[keytobesplit]
-        if len(value) > maxcardcharacterlength:
-         
-            i = 0
-            splitdicts=[]
-            while i < len(value):
-                end = i + maxcardcharacterlength
-              
-                # adjust end index to avoid word split
-                while end < len(value) and value[end] != ' ':
-                    end -= 1
-                # if we reached the start of the substring without finding a space
-                # then we forcibly split the word to meet the length limit
-                if end == i:
-                    end = i + maxcardcharacterlength
-                new_entry={}
-                new_entry=card.copy()
-                new_entry[keytobesplit] = value[i:end]
-                splitdicts.append(new_entry)
-                
-                i = end - overlap if end - overlap > i else end
-                #go back to the lastest space
-                while i>0 and abs(end-i)<overlap*2 and i<len(value) and value[i] != ' ':
-                     i-=1
-         
-            result.extend(splitdicts)
+        if compat:
+            ranges = compatsplitranges(value, maxcardcharacterlength, overlap) if len(value) > maxcardcharacterlength else None
         else:
+            ranges = splitranges(value, maxcardcharacterlength, overlap, sentences, maxtokens)
+        if ranges is None:
             result.append(card)
+            continue
+        for start, end in ranges:
+            new_entry=card.copy()
+            new_entry[keytobesplit] = value[start:end]
+            result.append(new_entry)
     return result
 
+def splitterprofile(compat=True, sentences=False, maxtokens=None):
+    """Options of the card splitter (see splitcards), pass the result as splitter= (None is the default profile).
+    :param compat: cut at the same positions as the original character by character splitter
+    :param sentences: prefer to cut at the end of a sentence, needs compat=False
+    :param maxtokens: max number of whitespace separated words per card in addition to the character limit, needs compat=False
+    :rtype: dict
+    :return: {"compat", "sentences", "maxtokens"}
+    """
+    if compat and (sentences or maxtokens is not None):
+        raise ValueError("sentences and maxtokens are only used by the splitter without compat")
+    return {"compat": compat, "sentences": sentences, "maxtokens": maxtokens}
+
+DEFAULTSPLITTER = splitterprofile()
+
+SPACE_RE = re.compile(" ")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])[\"')\]]* ")
+
+def spacepositions(value):
+    # helper function for the splitters, sorted positions of all spaces of the text (the word boundaries)
+    return [m.start() for m in SPACE_RE.finditer(value)]
+
+def compatsplitranges(value, maxcardcharacterlength, overlap):
+    """Cut positions of the original splitcards loop, found with bisect on the precomputed space positions
+    instead of scanning back one character at a time.
+    Where the original loop would come back to an already used start position and cycle forever (long text without
+    spaces and a large overlap), the next start is moved behind the furthest cut instead.
+    :param value: text of the card
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :return: list of (start, end) slices of value
+    """
+    n = len(value)
+    spaces = spacepositions(value)
+    ranges = []
+    visited = set()
+    furthest = 0
+    i = 0
+    while i < n:
+        while i in visited:  # the original loop would repeat itself from here
+            i = furthest if furthest > i else i + maxcardcharacterlength
+        if i >= n:
+            break
+        visited.add(i)
+        end = i + maxcardcharacterlength
+
+        # adjust end index to avoid word split: the latest space at or before end
+        if end < n:
+            k = bisect_right(spaces, end) - 1
+            if k >= 0:
+                end = spaces[k]
+            elif spaces:
+                end = spaces[-1] - n  # the original loop walks on into negative indices, i.e. from the end of the text
+            else:
+                end = i  # no space at all, split the word
+        # if we reached the start of the substring without finding a space
+        # then we forcibly split the word to meet the length limit
+        if end == i:
+            end = i + maxcardcharacterlength
+        ranges.append((i, end))
+        furthest = max(furthest, end)
+
+        i = end - overlap if end - overlap > i else end
+        #go back to the lastest space, but not further than 2*overlap before end
+        if 0 < i < n and end >= i:
+            k = bisect_right(spaces, i) - 1
+            i = min(i, max(spaces[k] if k >= 0 else 0, end - overlap*2, 0))
+        else:
+            while i>0 and abs(end-i)<overlap*2 and i<n and value[i] != ' ':
+                i-=1
+    return ranges
+
+def splitranges(value, maxcardcharacterlength, overlap, sentences=False, maxtokens=None):
+    """Linear time splitter, every cut is found with bisect on boundary positions computed once per card.
+    A chunk ends at the last sentence end (if sentences) or word boundary within the limits, a word longer than the
+    limit is split. The next chunk starts at the first word boundary inside the overlap.
+    :param value: text of the card
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param sentences: prefer to cut at the end of a sentence
+    :param maxtokens: max number of whitespace separated words per chunk
+    :return: list of (start, end) slices of value or None if the card does not need to be split
+    """
+    n = len(value)
+    spaces = spacepositions(value)
+    if n <= maxcardcharacterlength and (maxtokens is None or len(spaces) < maxtokens):
+        return None
+    sentenceends = [m.end() - 1 for m in SENTENCE_END_RE.finditer(value)] if sentences else []
+    ranges = []
+    i = 0
+    while i < n:
+        limit = i + maxcardcharacterlength
+        if maxtokens is not None:
+            k = bisect_right(spaces, i) + maxtokens - 1  # the space after the maxtokens-th word
+            if k < len(spaces):
+                limit = min(limit, spaces[k])
+        if limit >= n:
+            end = n
+        else:
+            end = None
+            if sentenceends:  # a sentence end in the second half of the chunk
+                k = bisect_right(sentenceends, limit) - 1
+                if k >= 0 and sentenceends[k] > i + (limit - i) // 2:
+                    end = sentenceends[k]
+            if end is None:
+                k = bisect_right(spaces, limit) - 1
+                if k >= 0 and spaces[k] > i:
+                    end = spaces[k]
+            if end is None:  # a single word longer than the limit
+                end = limit
+        ranges.append((i, end))
+        if end >= n:
+            break
+        k = bisect_left(spaces, end - overlap)
+        i = spaces[k] if k < len(spaces) and spaces[k] < end else end
+        i = max(i, ranges[-1][0] + 1)
+    return ranges
+
 def selectsmallestheadinglvl(size_tag):
     """Select suitable headinging depth .
     :param size_tag: statistics about the pdf fonts  
@@ -371,48 +840,525 @@ def selectsmallestheadinglvl(size_tag):
     except:
         return 3 #default
 
+LIGATURES = {"\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl", "\ufb05": "st", "\ufb06": "st"}
+LIGATURE_RE = re.compile("[" + "".join(LIGATURES) + "]")
+ASCII_LETTERS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+ASCII_LOWERCASE = frozenset("abcdefghijklmnopqrstuvwxyz")
+
+@lru_cache(maxsize=None)
+def nonprintablepattern():
+    # one character class with all non printable characters of the BMP, built on first use
+    ranges = []
+    start = None
+    for cp in range(0x10001):
+        if cp < 0x10000 and not chr(cp).isprintable():
+            if start is None:
+                start = cp
+        elif start is not None:
+            ranges.append(re.escape(chr(start)) + "-" + re.escape(chr(cp - 1)))
+            start = None
+    return re.compile("[" + "".join(ranges) + "]+")
+
 def charactercleanup(text):
-    return ''.join(c for c in text if c.isprintable()) #c.isalnum() or c.isspace() or c in '.,?!<>' or
+    if text.isprintable():
+        return text
+    text = nonprintablepattern().sub("", text)
+    if text.isprintable():
+        return text
+    return ''.join(c for c in text if c.isprintable()) # characters outside the BMP #c.isalnum() or c.isspace() or c in '.,?!<>' or
+
+def hyphenjoin(text):
+    """Removes the - binding word in linebreaks, same result as re.sub(r'([a-zA-Z])- ([a-z])', r'\1\2', text).
+    Only the occurrences of "- " are visited instead of trying the pattern at every character.
+    """
+    p = text.find("- ")
+    if p < 0:
+        return text
+    parts = []
+    last = 0  # start of the text not yet copied
+    free = 0  # first character a new match may start at, matches do not overlap
+    while p >= 0:
+        if p > free and text[p-1] in ASCII_LETTERS and text[p+2:p+3] in ASCII_LOWERCASE:
+            parts.append(text[last:p])
+            last = p+2
+            free = p+3
+        p = text.find("- ", p+1)
+    if not parts:
+        return text
+    parts.append(text[last:])
+    return "".join(parts)
+
+def normalizetext(text, normalization=None, ligatures=False):
+    """Removes the non printable characters in one pass, optionally expands the ligatures (\ufb01 -> fi) and applies a unicode normalization.
+    :param text: text to clean
+    :param normalization: None or unicode normal form "NFC", "NFKC", "NFD", "NFKD", NFKC also expands the ligatures
+    :param ligatures: expand the ligatures \ufb00-\ufb06
+    :return: cleaned text
+    """
+    text = charactercleanup(text)
+    if ligatures and LIGATURE_RE.search(text):
+        text = LIGATURE_RE.sub(lambda m: LIGATURES[m.group()], text)
+    if normalization:
+        text = unicodedata.normalize(normalization, text)
+    return text
 
 
-def convertpdftocards(pdfpath,maxcardcharacterlength,overlap, usefontsNcolor=True ):
+def convertpdftocards(pdfpath,maxcardcharacterlength,overlap, usefontsNcolor=True, workers=1, normalization=None, ligatures=False, profiler=None, source=None, storemaxsize=None, layout=False, dedup=None, extraction=None, splitter=None ):
     """turn pdf into text blocks / "cards" as if a human would read the document and split it into cards for memorizing and organizing the text.
      This function splits text along headings and page breaks 
-    :param pdfpath: path to pdf
+    :param pdfpath: path to pdf, or its content as bytes, bytearray, memoryview or mmap (see opendocument)
     :param maxcardcharacterlength: max size of card
     :param overlap: overlap between textblocks
     :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param workers: number of worker processes extracting page ranges in parallel, 1 extracts in this process.
+     In-memory content is always extracted in this process
+    :param normalization: unicode normal form applied to the card texts, None keeps the text as extracted (see normalizetext)
+    :param ligatures: expand ligatures like \ufb01 in the card texts
+    :param profiler: ConversionProfiler receiving stage timings, counts and peak memory (see conversionprofile), None disables it
+    :param source: name of the pdf in the card metadata, default the path, "<memory>" for in-memory content
+    :param storemaxsize: shrink the MuPDF store to this many bytes once the document is closed (see limitstore)
+    :param layout: read multi-column pages column by column and drop running headers and footers (see layoutspantable),
+     False keeps the extraction order
+    :param dedup: carddedup.CardDeduplicator dropping near-duplicate cards, pass the same one for all documents of a run to
+     also drop the duplicates of earlier documents. None keeps every card
+    :param extraction: extraction profile (see extractionprofile), None extracts the text without images and skips the pages
+     without text layer, their number is logged and counted as "skippedpages" by the profiler
+    :param splitter: splitter profile (see splitterprofile), None cuts the long cards at the positions of the original splitter
     :return: pdf split in cards by detected header
     """ 
     
 
 
-    print("PDFtoCards: ",pdfpath)
-    doc = fitz.open(pdfpath)  # open document
+    source = sourcename(pdfpath, source)
+    logger.info("PDFtoCards: %s", source)
+    profiler = profiler or NULLPROFILER
+    profiler.start(source)
+    complete = False
+    try:
+        with profiler.stage("open"):
+            doc = opendocument(pdfpath)  # open document
+        with documentclosing(doc, storemaxsize):
+            with profiler.stage("get_text"):
+                if workers > 1 and doc.page_count > 1 and isinstance(pdfpath, (str, os.PathLike)):
+                    spans = extractspantableparallel(pdfpath, workers, doc.page_count, extraction)
+                else:
+                    spans = extractspantable(doc, extraction=extraction)  # decode every page once, all stages below read the span table
+        profiler.count("pages", spans["pagecount"] - spans["firstpage"])
+        profiler.count("spans", len(spans["size"]))
+
+        cards = convertspantabletocards(spans, source, maxcardcharacterlength, overlap, usefontsNcolor, normalization, ligatures, profiler, layout, dedup,
+                                        splitter)
+        complete = True
+    finally:
+        profiler.finish(complete)
+    return cards
+
+def convertspantabletocards(spans, source, maxcardcharacterlength, overlap, usefontsNcolor=True, normalization=None, ligatures=False, profiler=None, layout=False, dedup=None, splitter=None):
+    """same as convertpdftocards, but works on an already extracted span table so the pdf does not need to be reopened
+    :param spans: span table (see extractspantable)
+    :param source: name of the pdf file processed / source, stored in the card metadata
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param layout: reading order and running header and footer removal (see convertpdftocards)
+    :param dedup: near-duplicate filter (see convertpdftocards)
+    :param splitter: splitter profile (see splitterprofile)
+    :return: pdf split in cards by detected header
+    """
+    profiler = profiler or NULLPROFILER
+    fontstats, colorstats, size_tag, headinglvl = documentstyles(spans, usefontsNcolor, profiler)
+    repeated = None
+    if layout:
+        with profiler.stage("layout"):
+            margins = RepeatedMargins()
+            margins.add(spans)
+            repeated = margins.keys()
+    cards = itercards([spans], source, fontstats, colorstats, size_tag, headinglvl, maxcardcharacterlength, overlap, usefontsNcolor, normalization, ligatures, profiler,
+                      layout=repeated, splitter=splitter)
+    return list(dedupstage(cards, dedup, profiler))
 
-    fontstats,colorstats=getweightedfontncolorstatisticsofdoc(doc)
+def documentstyles(spans, usefontsNcolor=True, profiler=None):
+    """Document level statistics needed before any card can be built.
+    :param spans: span table, the text columns are not needed (see extractspantable withtext)
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param profiler: ConversionProfiler or None
+    :return: fontstats, colorstats, size_tag, headinglvl
+    """
+    profiler = profiler or NULLPROFILER
+    with profiler.stage("statistics"):
+        fontstats,colorstats=getweightedfontncolorstatisticsofdoc(spans)
 
-    font_counts, styles=fonts(doc,fontstats,colorstats,usefontsNcolor)
+    with profiler.stage("fonts"):
+        font_counts, styles=fonts(spans,fontstats,colorstats,usefontsNcolor)
     # for k,s in styles.items():
     #     print("style:",s)
-    size_tag =font_tags(font_counts, styles)
+    with profiler.stage("font_tags"):
+        size_tag =font_tags(font_counts, styles)
 
     headinglvl=selectsmallestheadinglvl(size_tag)
     #print(headinglvl)
-    result = headers_para(doc,size_tag,fontstats,colorstats,usefontsNcolor)
+    return fontstats, colorstats, size_tag, headinglvl
 
-    
-    
-    #remove the - binding word in linebreaks
-    cresults=[]
-    for ele in result:
-       t=re.sub(r'([a-zA-Z])- ([a-z])', r'\1\2', ele)
-       cresults.append(charactercleanup(t))
-
-    #print("\n HeadersPara:",cresults)
-    cards= buildcards(cresults, pdfpath,headinglvl)
-    scards=splitcards(cards,maxcardcharacterlength,overlap)
-    return  [x for x in scards if not x['page_content'].isspace() and not x['page_content']==""]
+def itercards(tables, source, fontstats, colorstats, size_tag, headinglvl, maxcardcharacterlength, overlap, usefontsNcolor=True, normalization=None, ligatures=False, profiler=None, validheaders=None, layout=None, splitter=None):
+    """Yields the finished and split cards of consecutive span tables.
+    :param tables: iterable of span tables in page order
+    :param source: name of the pdf file processed / source, stored in the card metadata
+    :param profiler: ConversionProfiler or None, every stage of the pipeline is timed separately
+    :param validheaders: headers in effect at the first page of tables (see headingcontext)
+    :param layout: margin keys of the running headers and footers (see pagelayout.RepeatedMargins) to bring the tables into
+     reading order with layoutspantable, None keeps the extraction order
+    :param splitter: splitter profile (see splitterprofile), None is the original splitter
+    :return: generator of cards
+    """
+    profiler = profiler or NULLPROFILER
+    skipped = 0  # pages without text layer
+
+    def countskipped(tables):
+        nonlocal skipped
+        for spans in tables:
+            skipped += spans["skippedpages"]
+            yield spans
+
+    tables = countskipped(tables)
+    if layout is not None:
+        tables = profiler.timeiter("layout", (layoutspantable(spans, layout) for spans in tables))
+    elements = profiler.timeiter("headers_para", iterelements(tables,size_tag,fontstats,colorstats,usefontsNcolor))
+    elements = profiler.timeiter("cleanup", cleanelements(elements))
+    cards = profiler.timeiter("buildcards", iterbuildcardsfromelements(elements, source,headinglvl, validheaders))
+    cards = profiler.timeiter("normalize", normalizecards(cards, normalization, ligatures))
+
+    try:
+        for x in profiler.timeiter("splitcards", itersplitcards(cards, maxcardcharacterlength, overlap, splitter)):
+            if not x['page_content'].isspace() and not x['page_content']=="":
+                profiler.count("cards", 1)
+                yield x
+    finally:
+        if skipped:
+            profiler.count("skippedpages", skipped)
+            logger.info("%s: %d pages without text layer skipped", source, skipped)
+
+def dedupstage(cards, dedup, profiler=None):
+    # the dedup stage after splitcards, runs on the finished cards so the held back cards of itersampledcards are never indexed
+    if dedup is None:
+        return cards
+    profiler = profiler or NULLPROFILER
+    return profiler.timeiter("dedup", dedup.filtercards(cards))
+
+def normalizecards(cards, normalization=None, ligatures=False):
+    # the character cleanup only removes or replaces single characters, so it is done once per card instead of per element
+    for card in cards:
+        card["page_content"] = normalizetext(card["page_content"], normalization, ligatures)
+        card["metadata"]["title"] = normalizetext(card["metadata"]["title"], normalization, ligatures)
+        yield card
+
+def itersplitcards(cards, maxcardcharacterlength, overlap, splitter=None):
+    # splitcards for a stream of cards with the options of the splitter profile
+    splitter = splitter or DEFAULTSPLITTER
+    for card in cards:
+        yield from splitcards([card],maxcardcharacterlength,overlap, **splitter)
+
+def cleanelements(elements):
+    # remove the - binding word in linebreaks from the element texts, the non printable characters are removed per card
+    for element in elements:
+        if element.kind != "page":
+            element.text = hyphenjoin(element.text)
+        yield element
+
+def iterpdftocards(pdfpath,maxcardcharacterlength,overlap, usefontsNcolor=True, normalization=None, ligatures=False, profiler=None, samplepages=None, source=None, storemaxsize=None, layout=False, dedup=None, extraction=None, splitter=None):
+    """Generator version of convertpdftocards, yields finished and split cards as each heading section closes.
+    The font statistics pre-pass keeps no text, afterwards the pages are decoded again one at a time.
+    :param pdfpath: path to pdf, or its content in memory (see opendocument)
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param normalization: unicode normal form applied to the card texts (see normalizetext)
+    :param ligatures: expand ligatures like \ufb01 in the card texts
+    :param profiler: ConversionProfiler or None, the report is finished once the last card was yielded
+    :param samplepages: estimate the styles from this many pages (see sampledocumentstyles) instead of a pass over all pages,
+     so the first card is ready sooner. From the first page with a span size the sample did not see on, the cards are built
+     with the styles of the full pass, the cards yielded before are not corrected and may have other titles than those of
+     a full run. Only used without usefontsNcolor (see usesample), None always uses the full pass
+    :param source: name of the pdf in the card metadata, default the path
+    :param storemaxsize: shrink the MuPDF store to this many bytes once the document is closed (see limitstore)
+    :param layout: reading order and running header and footer removal (see convertpdftocards), the running headers and
+     footers are found in the pages of the styles pass
+    :param dedup: near-duplicate filter (see convertpdftocards)
+    :param extraction: extraction profile (see extractionprofile)
+    :param splitter: splitter profile (see splitterprofile)
+    :return: generator of cards, same cards as convertpdftocards (without samplepages). The document is closed when the
+     generator is exhausted or closed
+    """
+    source = sourcename(pdfpath, source)
+    logger.info("PDFtoCards: %s", source)
+    profiler = profiler or NULLPROFILER
+    profiler.start(source)
+    complete = False
+    try:
+        with profiler.stage("open"):
+            doc = opendocument(pdfpath)  # open document
+        margins = RepeatedMargins() if layout else None
+        with documentclosing(doc, storemaxsize):
+            if usesample(samplepages, doc.page_count, usefontsNcolor):
+                styles = sampledocumentstyles(doc, samplepages, usefontsNcolor, profiler, margins, extraction)
+                repeated = None if margins is None else margins.keys()
+                cards = itersampledcards(doc, source, range(doc.page_count), styles, maxcardcharacterlength, overlap, usefontsNcolor,
+                                         normalization, ligatures, profiler, layout=repeated, extraction=extraction, splitter=splitter)
+            else:
+                styles = fulldocumentstyles(doc, usefontsNcolor, profiler, margins, extraction)
+                repeated = None if margins is None else margins.keys()
+                tables = profiler.timeiter("get_text", iterspantablepages(doc, extraction=extraction))
+                cards = itercards(tables, source, *styles, maxcardcharacterlength, overlap, usefontsNcolor, normalization, ligatures, profiler,
+                                  layout=repeated, splitter=splitter)
+            yield from dedupstage(cards, dedup, profiler)
+        complete = True
+    finally:
+        # also reports a conversion that raised or whose generator was closed early
+        profiler.finish(complete)
+
+def fulldocumentstyles(doc, usefontsNcolor=True, profiler=None, margins=None, extraction=None):
+    # documentstyles from every page, the text is not kept. Every page is counted by margins (RepeatedMargins) if given
+    profiler = profiler or NULLPROFILER
+    with profiler.stage("get_text_styles"):
+        if margins is None:
+            spans = extractspantable(doc, withtext=False, extraction=extraction)
+        else:
+            margins.clear()
+            spans = newspantable()
+            for pno, page in enumerate(doc):
+                blocks = pagetextblocks(page, extraction)
+                appendpagetospantable(spans, blocks, pno, withtext=False)
+                margins.add(appendpagetospantable(newspantable(pno), blocks, pno))
+    profiler.count("pages", spans["pagecount"] - spans["firstpage"])
+    profiler.count("spans", len(spans["size"]))
+    return documentstyles(spans, usefontsNcolor, profiler)
+
+def usesample(samplepages, pagecount, usefontsNcolor=True):
+    # With fonts and colors the heading levels depend on the font and color shares of the whole document, the shares of a
+    # sample rank the augmented sizes differently and its styles would (nearly) always be rejected, so only the size
+    # based styles are estimated from a sample
+    return bool(samplepages) and samplepages < pagecount and not usefontsNcolor
+
+def samplepagenumbers(pagecount, samplepages, seed=0):
+    """Stratified page sample: the document is cut into samplepages equal parts and one random page of every part is taken.
+    :param pagecount: number of pages of the document
+    :param samplepages: size of the sample
+    :param seed: random seed, the same document always gets the same sample
+    :return: sorted page numbers (0 based)
+    """
+    if samplepages >= pagecount:
+        return list(range(pagecount))
+    r = random.Random(seed)
+    bounds = [pagecount*i//samplepages for i in range(samplepages+1)]
+    return [r.randrange(bounds[i], bounds[i+1]) for i in range(samplepages)]
+
+def sampledocumentstyles(doc, samplepages, usefontsNcolor=True, profiler=None, margins=None, extraction=None):
+    """documentstyles estimated from a stratified sample of the pages (see samplepagenumbers).
+    The sample is only trusted if it covers the sizes well enough (see samplecoverssizes), a sample without text or without
+    any heading size is not trusted either, then the full pass is used. A heading size the sample did not see at all can
+    not be detected here: later pages with it fall back to the full pass (see itersampledcards), but the cards yielded
+    before that are not corrected.
+    :param doc: PDF document
+    :param samplepages: number of pages of the sample
+    :param margins: RepeatedMargins counting the sampled pages (all pages after a fall back), None counts nothing
+    :return: fontstats, colorstats, size_tag, headinglvl
+    """
+    profiler = profiler or NULLPROFILER
+    sample = newspantable()
+    with profiler.stage("get_text_sample"):
+        for pno in samplepagenumbers(doc.page_count, samplepages):
+            blocks = pagetextblocks(doc[pno], extraction)
+            appendpagetospantable(sample, blocks, pno, withtext=False)
+            if margins is not None:
+                margins.add(appendpagetospantable(newspantable(pno), blocks, pno))
+    profiler.count("sampledpages", samplepages)
+    try:
+        styles = documentstyles(sample, usefontsNcolor, profiler)
+    except ValueError:  # no spans or no heading size in the sample
+        styles = None
+    with profiler.stage("sample_check"):
+        confident = styles is not None and samplecoverssizes(
+            sample, getspansizeswithgranularityColorFont(sample, *styles[:2], usefontsNcolor), styles[2], samplepages)
+    if not confident:
+        logger.info("the page sample does not cover the sizes reliably, using the statistics of all pages")
+        profiler.count("fallbacks", 1)
+        return fulldocumentstyles(doc, usefontsNcolor, profiler, margins, extraction)
+    return styles
+
+SAMPLEMARGIN = 2.0  # standard errors the paragraph size has to lead every other size by on the sampled pages
+SAMPLEHEADINGPAGES = 3  # sampled pages every heading size has to be on
+
+def samplecoverssizes(spans, sizes, size_tag, samplepages):
+    """True if the sample is large enough for its styles: the heading levels depend on the paragraph size (the most common
+    size) and on the ranking of the larger sizes. On the sampled pages the paragraph size has to be more common than every
+    other size by SAMPLEMARGIN standard errors of the per page differences, and every heading size has to be on at least
+    SAMPLEHEADINGPAGES pages, a size seen on only one or two pages suggests more sizes the sample missed.
+    :param spans: span table of the sampled pages
+    :param sizes: size of every span as used for size_tag (see getspansizeswithgranularityColorFont)
+    :param size_tag: tags of the sample (see font_tags)
+    :param samplepages: number of sampled pages, pages without spans count as pages without any size
+    :rtype: bool
+    """
+    distinct = np.array(sorted(size_tag), dtype=np.float64)
+    _, page = np.unique(np.asarray(spans["page"], dtype=np.int64), return_inverse=True)
+    counts = np.zeros((max(samplepages, 2), len(distinct)))
+    np.add.at(counts, (page.reshape(-1), np.searchsorted(distinct, np.asarray(sizes, dtype=np.float64))), 1)
+    tags = [size_tag[size] for size in distinct.tolist()]
+    p = tags.index("<p>")
+    differences = counts[:, [p]] - np.delete(counts, p, axis=1)
+    margin = SAMPLEMARGIN * differences.std(axis=0, ddof=1) / np.sqrt(len(counts))
+    headings = [i for i, tag in enumerate(tags) if tag.startswith("<h")]
+    return bool(np.all(differences.mean(axis=0) > margin) and np.all((counts[:, headings] > 0).sum(axis=0) >= SAMPLEHEADINGPAGES))
+
+def itersampledcards(doc, source, pages, styles, maxcardcharacterlength, overlap, usefontsNcolor=True, normalization=None, ligatures=False, profiler=None, validheaders=None, layout=None, extraction=None, splitter=None):
+    """itercards of consecutive pages with styles estimated from a sample. When a page contains a span size the sample did not
+    see (UnseenStyleError), the full pass is run and this page and the following ones are carded with the full styles.
+    Cards are held back until their page is complete, so no card of the failing page has been yielded before. The cards of
+    the earlier pages are not corrected: if the missing size is a heading size, their heading levels may differ from a full run.
+    :param doc: PDF document
+    :param pages: consecutive page numbers
+    :param styles: sampled styles (see sampledocumentstyles)
+    :param layout: running header and footer keys for the reading order (see itercards)
+    :param extraction: extraction profile (see extractionprofile)
+    :param splitter: splitter profile (see splitterprofile)
+    :return: generator of cards, its return value are the styles used for the last page (styles or the full styles)
+    """
+    profiler = profiler or NULLPROFILER
+    pending = []  # cards of the last page seen
+    pendingsource = None
+    try:
+        tables = profiler.timeiter("get_text", iterspantablepages(doc, pages, extraction))
+        for card in itercards(tables, source, *styles, maxcardcharacterlength, overlap, usefontsNcolor, normalization, ligatures,
+                              profiler, validheaders, layout, splitter):
+            if card["metadata"]["source"] != pendingsource:
+                yield from pending
+                pending = []
+                pendingsource = card["metadata"]["source"]
+            pending.append(card)
+    except UnseenStyleError as e:
+        logger.info("size %s on page %d is not in the sample, falling back to the statistics of all pages", e.size, e.page+1)
+        profiler.count("fallbacks", 1)
+        if pendingsource != source+" Page "+str(e.page+1):
+            yield from pending
+        else:
+            profiler.count("cards", -len(pending))
+        styles = fulldocumentstyles(doc, usefontsNcolor, profiler, extraction=extraction)
+        with profiler.stage("headingcontext"):
+            validheaders = headingcontext(doc, e.page, *styles, usefontsNcolor, layout, extraction)
+        tables = profiler.timeiter("get_text", iterspantablepages(doc, [p for p in pages if p >= e.page], extraction))
+        yield from itercards(tables, source, *styles, maxcardcharacterlength, overlap, usefontsNcolor, normalization, ligatures,
+                             profiler, validheaders, layout, splitter)
+        return styles
+    yield from pending
+    return styles
+
+def headingcontext(doc, pno, fontstats, colorstats, size_tag, headinglvl, usefontsNcolor=True, layout=None, extraction=None):
+    """Headers in effect at the start of page pno, the same validheaders a full run of buildcards has when it reaches the page.
+    The previous pages are decoded backwards until a top level header closes the context, not the whole document.
+    :param doc: PDF document
+    :param pno: page number (0 based)
+    :param fontstats, colorstats, size_tag, headinglvl: document styles (see documentstyles)
+    :param layout: running header and footer keys, the previous pages are read in the same order as by itercards
+    :param extraction: extraction profile (see extractionprofile)
+    :return: validheaders, list of headinglvl+1 header texts
+    """
+    validheaders = [""]*(headinglvl+1)
+    bound = headinglvl+1  # a header is only still in effect if no later header has the same or a higher level
+    for previous in range(pno-1, -1, -1):
+        tables = iterspantablepages(doc, [previous], extraction)
+        if layout is not None:
+            tables = (layoutspantable(spans, layout) for spans in tables)
+        headers = [e for e in cleanelements(iterelements(tables, size_tag, fontstats, colorstats, usefontsNcolor))
+                   if e.kind == "h" and e.level is not None and e.level<=headinglvl and "@" not in e.text]
+        for e in reversed(headers):
+            if e.level < bound:
+                validheaders[e.level] = e.text
+                bound = e.level
+        if bound <= 1:
+            break
+    return validheaders
+
+def pageranges(pages):
+    # sorted, de-duplicated page numbers grouped into runs of consecutive pages
+    runs = []
+    for pno in sorted(set(pages)):
+        if runs and runs[-1][-1] == pno-1:
+            runs[-1].append(pno)
+        else:
+            runs.append([pno])
+    return runs
+
+def iterpagestocards(pdfpath, pages, maxcardcharacterlength, overlap, usefontsNcolor=True, styles=None, normalization=None, ligatures=False, profiler=None, samplepages=None, source=None, storemaxsize=None, extraction=None, splitter=None):
+    """Cards of some pages only, the same cards (text, title and source) a full convertpdftocards gives for these pages.
+    Only the requested pages and the pages needed for their heading context are decoded.
+    :param pdfpath: path to pdf, or its content in memory (see opendocument)
+    :param pages: page numbers (0 based), e.g. range(10, 20)
+    :param maxcardcharacterlength: max size of card
+    :param overlap: overlap between textblocks
+    :param usefontsNcolor: use fonts and color as distinguishing characteristics to detect headers
+    :param styles: document styles (fontstats, colorstats, size_tag, headinglvl) of an earlier run (see documentstyles and
+     cardcache.documentstylescached), None computes them from all pages
+    :param samplepages: without styles, estimate them from this many pages like iterpdftocards does. A heading size the
+     sample missed is only noticed if it is on one of the requested pages, otherwise the cards keep the sampled heading levels
+    :param source: name of the pdf in the card metadata, default the path
+    :param storemaxsize: shrink the MuPDF store to this many bytes once the document is closed (see limitstore)
+    :param extraction: extraction profile (see extractionprofile)
+    :param splitter: splitter profile (see splitterprofile)
+    :return: generator of cards in page order
+    """
+    source = sourcename(pdfpath, source)
+    logger.info("PDFtoCards: %s pages %s", source, pages)
+    profiler = profiler or NULLPROFILER
+    profiler.start(source)
+    complete = False
+    try:
+        with profiler.stage("open"):
+            doc = opendocument(pdfpath)  # open document
+        with documentclosing(doc, storemaxsize):
+            yield from iterpagerangecards(doc, source, pages, maxcardcharacterlength, overlap, usefontsNcolor, styles, normalization,
+                                          ligatures, profiler, samplepages, extraction, splitter)
+        complete = True
+    finally:
+        profiler.finish(complete)
+
+def iterpagerangecards(doc, source, pages, maxcardcharacterlength, overlap, usefontsNcolor=True, styles=None, normalization=None, ligatures=False, profiler=None, samplepages=None, extraction=None, splitter=None):
+    # iterpagestocards of an open document
+    profiler = profiler or NULLPROFILER
+    sampled = False
+    if styles is None:
+        if usesample(samplepages, doc.page_count, usefontsNcolor):
+            styles = sampledocumentstyles(doc, samplepages, usefontsNcolor, profiler, extraction=extraction)
+            sampled = True
+        else:
+            styles = fulldocumentstyles(doc, usefontsNcolor, profiler, extraction=extraction)
+    for run in pageranges(p for p in pages if 0 <= p < doc.page_count):
+        profiler.count("pages", len(run))
+        if sampled:
+            try:
+                with profiler.stage("headingcontext"):
+                    validheaders = headingcontext(doc, run[0], *styles, usefontsNcolor, extraction=extraction)
+            except UnseenStyleError:
+                styles = fulldocumentstyles(doc, usefontsNcolor, profiler, extraction=extraction)
+                sampled = False
+        if sampled:
+            # after a fall back the full styles are returned and used for the following runs
+            used = yield from itersampledcards(doc, source, run, styles, maxcardcharacterlength, overlap, usefontsNcolor,
+                                               normalization, ligatures, profiler, validheaders, extraction=extraction,
+                                               splitter=splitter)
+            sampled = used is styles
+            styles = used
+        else:
+            with profiler.stage("headingcontext"):
+                validheaders = headingcontext(doc, run[0], *styles, usefontsNcolor, extraction=extraction)
+            tables = profiler.timeiter("get_text", iterspantablepages(doc, run, extraction))
+            yield from itercards(tables, source, *styles, maxcardcharacterlength, overlap, usefontsNcolor,
+                                 normalization, ligatures, profiler, validheaders, splitter=splitter)
+
+def convertpagestocards(pdfpath, pages, maxcardcharacterlength, overlap, usefontsNcolor=True, styles=None, normalization=None, ligatures=False, profiler=None, samplepages=None, source=None, storemaxsize=None, extraction=None, splitter=None):
+    """List version of iterpagestocards.
+    :return: cards of the pages
+    """
+    return list(iterpagestocards(pdfpath, pages, maxcardcharacterlength, overlap, usefontsNcolor, styles, normalization, ligatures, profiler, samplepages,
+                                 source, storemaxsize, extraction, splitter))
 
 # def main():
     